@@ -2,9 +2,18 @@
 CPU assembler
 '''
 
+import io
 import os
+import re
+import glob
+import bisect
 import sys
+import mmap
+import marshal
+import hashlib
 import argparse
+import functools
+import contextlib
 from collections import namedtuple
 
 # Separators
@@ -17,6 +26,25 @@ SPEC_CMD_CHAR = '@'
 ALIAS_DEF = 'ALIAS'
 BASE_ADDR = 'BASEADDR'
 INC_FILE = 'INCLUDE'
+# Jump address given as a number instead of a label, starting with a digit to tell it from a label name
+LITERAL_ADDRESS = re.compile(r'[0-9][0-9a-fA-F]*[hH]$')
+
+# Folder of the programs translated before, see translate_cached
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asm.cache')
+# Change when translations change, entries of other versions are then ignored
+CACHE_VERSION = 4
+
+# Bytes of a full code image
+IMAGE_SIZE = 0x10000
+# Code image formats by file extension, see write_binary and write_hex
+IMAGE_FORMATS = {'.bin': 'bin', '.hex': 'hex'}
+# Intel HEX record types and data bytes per record
+HEX_DATA = 0x00
+HEX_EOF = 0x01
+HEX_RECORD = 16
+
+# Line of a code file written by write_code
+CODE_LINE = re.compile(r'([0-9a-fA-F]{4}):((?:\s+[0-9a-fA-F]{4})+)$')
 
 # Instruction set
 INST_SET = {'ADD': {'code': '00', 'params': [], 'descr': 'Set A = A + B'},
@@ -95,8 +123,11 @@ INST_SET = {'ADD': {'code': '00', 'params': [], 'descr': 'Set A = A + B'},
             'NOP': {'code': 'ff', 'params': [], 'descr': 'No operation'},
             }
 
-# Global variables
-aliases = {}
+# Bytes taken by each kind of instruction parameter
+PARAM_SIZE = {'value': 1, 'page': 1, 'addr': 2, 'addr_l': 2}
+# (name, params, bytes) of each instruction by code
+OPCODES = {int(info['code'], 16): (name, info['params'], 1 + sum(PARAM_SIZE[param] for param in info['params']))
+           for name, info in INST_SET.items()}
 
 class LabelManager():
     'Class to keep track of labels in code'
@@ -104,8 +135,12 @@ class LabelManager():
     PL_H_STR = 'XXXX'
 
     def __init__(self, debug=False):
+        # Address of each label
         self.labels = {}
+        # Addresses of the instructions referencing each label before it was defined
         self.placeholders = {}
+        # (instruction address, label) of every reference to fill in once all labels are known
+        self.fixups = []
         self.debug = debug
 
     def set_debug(self, debug=False):
@@ -114,48 +149,46 @@ class LabelManager():
     def add_label(self, name, address):
         'Store a label and the address it points to when defined'
         if self.debug:
-            print('Adding label', '"' + name + '"', 'pointing to address', dec_to_hex(int(address)))
+            print('Adding label', '"' + name + '"', 'pointing to address', dec_to_hex(address))
         if name in self.labels:
             return False
-        self.labels[name] = dec_to_hex(int(address))
+        self.labels[name] = address
         return True
 
     def add_placeholder(self, name, address):
         'Store a reference to a not-yet-defined label'
-        if name in self.placeholders:
-            self.placeholders[name].append(dec_to_hex(int(address)))
-        else:
-            self.placeholders[name] = [dec_to_hex(int(address))]
+        self.placeholders.setdefault(name, []).append(address)
+        self.fixups.append((address, name))
         if self.debug:
-            print('Adding address', dec_to_hex(int(address)), 'to placeholder', '"' + name + '"', '(', len(self.placeholders[name]), ')')
+            print('Adding address', dec_to_hex(address), 'to placeholder', '"' + name + '"', '(', len(self.placeholders[name]), ')')
         return self.PL_H_STR
 
-    def resolve_refs(self, code, offset):
-        'Resolve all stored references to labels'
-        max_offset = offset + int(len(code)/2)
+    def resolve_refs(self, segments):
+        '''Write the address of the label of every stored reference in the {offset: bytearray} code segments
+        Return an error message, None if all labels are defined'''
+        offsets = sorted(segments)
         if self.debug:
-            print('Resolving references between offset=', offset, 'and max=', max_offset)
+            print('Resolving references in segments at offsets', ', '.join(dec_to_hex(offset) for offset in offsets))
             print('Code in')
-            #print(code)
-            print(format_code({offset: code}, True, False, False))
-        for name in self.placeholders:
+            print(format_code({offset: segments[offset].hex() for offset in offsets}, True, False, False))
+        for position, name in self.fixups:
             if name not in self.labels:
                 return 'Error: label "' + name + '" not defined'
-            for position in self.placeholders[name]:
-                address = self.labels[name]
-                index = (int(position, base=16) - offset) * 2
-                if (index > len(code)) or (int(position, base=16) < offset):
-                    if self.debug:
-                        print('Address', position, 'not in code extent', offset, '-', max_offset)
-                    continue
-                code = code[:index + 2] + address + code[index + 6:]
+            address = self.labels[name]
+            # Segment holding the instruction, the address follows its code
+            offset = offsets[bisect.bisect_right(offsets, position) - 1] if offsets[0] <= position else None
+            if offset is None or position + 3 > offset + len(segments[offset]):
                 if self.debug:
-                    print('Replacing ref to label', '"' + name + '"', '(' + address + ')', 'at', position)
+                    print('Address', dec_to_hex(position), 'not in code extent')
+                continue
+            index = position - offset + 1
+            segments[offset][index:index + 2] = address.to_bytes(2, 'big')
+            if self.debug:
+                print('Replacing ref to label', '"' + name + '"', '(' + dec_to_hex(address) + ')', 'at', dec_to_hex(position))
         if self.debug:
             print('Code out')
-            #print(code)
-            print(format_code({offset: code}, True, False, False))
-        return code
+            print(format_code({offset: segments[offset].hex() for offset in offsets}, True, False, False))
+        return None
 
     def label_exists(self, name):
         'Check if a label exists'
@@ -167,10 +200,7 @@ class LabelManager():
 
     def get_label_address(self, name):
         'Return the address of a label if defined'
-        if name in self.labels:
-            return self.labels[name]
-        else:
-            return None
+        return self.labels.get(name)
 
 def print_instr_set():
     'Print the instruction set'
@@ -179,40 +209,38 @@ def print_instr_set():
 
 def get_instr_from_code(code):
     'Print the instruction info given the code'
-    for instr in INST_SET:
-        if INST_SET[instr]['code'] == code:
-            return instr + ' (' + INST_SET[instr]['descr'] + ')'
-    return ''
+    opcode = OPCODES.get(int(code, 16))
+    if opcode is None:
+        return ''
+    return opcode[0] + ' (' + INST_SET[opcode[0]]['descr'] + ')'
+
+def tokenize(line, symbols=None):
+    '''Split a line of code in tokens, dropping the comment
+    Tokens that are names in symbols are replaced by the tokens of their value'''
+    tokens = line.split(COMMENT_SEP, maxsplit=1)[0].split()
+    if not symbols:
+        return tokens
+    expanded = []
+    for token in tokens:
+        value = symbols.get(token)
+        if value is None:
+            expanded.append(token)
+        else:
+            expanded.extend(value.split())
+    return expanded
 
-def add_alias(name, value_str, debug=False):
-    if debug:
-        print('Adding alias', '"' + name + '"', 'with value', '"' + value_str + '"')
-    aliases[name] = value_str
-    return True
-
-def pre_process(line):
-    'Replace aliases in line'
-    for alias in aliases:
-        #print('line=',line, 'alias=', alias, 'aliases[alias]=', aliases[alias])
-        line = line.replace(alias, aliases[alias])
-        #print('line after', line)
-    return line
-
-def parse_line(line):
-    'Parse a line of code'
+def parse_line(line, symbols=None):
+    'Parse a line of code, replacing the names in symbols (e.g. aliases) by their value'
     label = None
     instr = None
     params = []
-    code = line.split(COMMENT_SEP, maxsplit=1)
-    code = code[0].strip()
-    if code:
-        for item in code.split():
-            if item.endswith(LABEL_SEP):
-                label = item[:-1]
-            elif not instr:
-                instr = item
-            else:
-                params.append(item)
+    for item in tokenize(line, symbols):
+        if item.endswith(LABEL_SEP):
+            label = item[:-1]
+        elif not instr:
+            instr = item
+        else:
+            params.append(item)
     return {'label':label, 'instr':instr, 'params':params}
 
 def validate_hex(in_str, max_len):
@@ -225,34 +253,6 @@ def validate_hex(in_str, max_len):
     in_str = in_str[:-1]
     return in_str.zfill(max_len)
 
-def validate_params(command, at_address, debug):
-    #print(command['instr'], command['params'])
-    #print(INST_SET[command['instr']])
-    if len(command['params']) != len(INST_SET[command['instr']]['params']):
-        ret_str = 'Error: Parameter count mismatch for ' + command['instr']
-    else:
-        ret_str = ''
-        for (arg, param) in zip(command['params'], INST_SET[command['instr']]['params']):
-            if param == 'value':
-                arg = validate_hex(arg, 2)
-                ret_str = ret_str + arg
-            elif param == 'addr':
-                arg = validate_hex(arg, 4)
-                ret_str = ret_str + arg
-            elif param == 'addr_l':
-                if label_mgr.label_exists(arg):
-                    arg = label_mgr.get_label_address(arg) + 'h'
-                else:
-                    arg = label_mgr.add_placeholder(arg, at_address) + 'h'
-                arg = validate_hex(arg, 4)
-                ret_str = ret_str + arg
-            elif param == 'page':
-                arg = validate_hex(arg, 2)
-                ret_str = ret_str + arg
-            else:
-                ret_str = 'Error: Unrecognized parameter type'
-    return ret_str
-
 def dec_to_hex(dec_value, places=4):
     return hex(dec_value)[2:].zfill(places)
 
@@ -262,56 +262,6 @@ def pad_line(in_str, pad='ff', length=128):
             in_str = in_str + pad
     return in_str
 
-def process_line(line, at_address, debug=False):
-    ret_str = ''
-    new_offset = None
-    if line.startswith(SPEC_CMD_CHAR):
-        info = parse_line(line[1:])
-        #print('line', line)
-        #print('info', info)
-        if info['label']:
-            ret_str = 'Error: wrong special command syntax'
-        if info['instr'] == ALIAS_DEF:
-            if len(info['params']) < 2:
-                ret_str = 'Error: ALIAS definition syntax'
-            else:
-                add_alias(info['params'][0], ' '.join(info['params'][1:]), debug)
-        elif info['instr'] == INC_FILE:
-            pass
-            # if len(info['params']) != 1:
-                # ret_str = 'Error: INC_FILE definition syntax'
-            # else:
-                # ret_str = translate_file(info['params'][0], at_address, debug)
-        elif info['instr'] == BASE_ADDR:
-            if len(info['params']) != 1:
-                ret_str = 'Error: BASE_ADDR definition syntax'
-            else:
-                offset_val = validate_hex(info['params'][0], 4)
-                if offset_val.startswith('Error'):
-                    print(offset_val)
-                else:
-                    new_offset = int(offset_val, 16)
-                    if debug:
-                        print('Setting new base address to', offset_val, '(', new_offset, ')')
-                    if not valid_offset(new_offset):
-                        ret_str = 'Error: BASE_ADDR has to be a multiple of 64 (40h)'
-        else:
-            ret_str = 'Error: Unrecognized special command'
-    else:
-        line = pre_process(line)
-        command = parse_line(line)
-        if command['label']:
-            if not label_mgr.add_label(command['label'], at_address):
-                ret_str = 'Error: Duplicate label definition'
-        if command['instr']:
-            if command['instr'] not in INST_SET:
-                ret_str = 'Error: Invalid instruction ' + command['instr']
-            else:
-                ret_str = validate_params(command, at_address, debug)
-                if not ret_str.startswith('Error'):
-                    ret_str = INST_SET[command['instr']]['code'] + ret_str
-    return ret_str, new_offset
-
 def format_code(code, ruler=False, pad=True, debug=False):
     # Separate the code in chunks of 128 chars (64 bytes)
     # Add a space every 4 chars (2 bytes)
@@ -319,50 +269,32 @@ def format_code(code, ruler=False, pad=True, debug=False):
     # prepend with offset + 64 * (n_line -1)
     # If ruler, add horizontal ruler
     # If pad, add 'ff' until 128 chars if line is shorter
-    out_str = ''
+    lines = []
     for offset in code:
-        print_list = chunks(code[offset], 128)
+        text = code[offset]
         if debug:
             print('Formatting code at offset=', offset)
-            print(print_list)
-        for count, entry in enumerate(print_list):
+        for count, start in enumerate(range(0, len(text), 128)):
+            entry = text[start:start + 128]
             if debug:
                 print('chunk=', count, entry)
             if pad:
                 padded_line = entry.ljust(128, 'f')
             else:
                 padded_line = entry
-            line1 = padded_line[:64]
-            line1 = ' '.join([line1[i:i+4] for i in range(0, len(line1), 4)])
-            line2 = ''
+            line1 = ' '.join([padded_line[i:i+4] for i in range(0, min(len(padded_line), 64), 4)])
+            line2 = ' '.join([padded_line[i:i+4] for i in range(64, len(padded_line), 4)])
             address = dec_to_hex(offset + count * 64)
-            if len(padded_line) > 64:
-                line2 = padded_line[64:]
-                line2 = ' '.join([line2[i:i+4] for i in range(0, len(line2), 4)])
             if ruler:
-                #print(address, address[-2:])
-                # print(line1)
-                # print(len(line1))
                 start = int(address[-2:], base=16)
                 ruler1 = ''.join([dec_to_hex(start + i * 4, 2) + '        ' for i in range(0, int(len(line1) / 10) + 1)])
                 ruler2 = ''
-                # print(line2)
-                # print(len(line2))
                 if line2:
                     start = start + 32
                     ruler2 = ''.join([dec_to_hex(start + i * 4, 2) + '        ' for i in range(0, int(len(line2) / 10) + 1)])
-                ruler = '      ' + ruler1 + ' ' + ruler2 + '\n'
-                # print(ruler1)
-                # print(ruler2)
-            else:
-                ruler = ''
-            out_str = out_str + ruler
-            out_str = out_str + address + ': '
-            out_str = out_str + line1 + '  ' + line2 + '\n'
-    return out_str.rstrip()
-
-def chunks(object, size):
-    return [object[i:i+size] for i in range(0, len(object), size)]
+                lines.append('      ' + ruler1 + ' ' + ruler2)
+            lines.append(address + ': ' + line1 + '  ' + line2)
+    return '\n'.join(lines).rstrip()
 
 def read_file(file_name, debug=False):
     try:
@@ -397,76 +329,396 @@ def read_file(file_name, debug=False):
 def valid_offset(offset):
     return (offset % 64) == 0
 
-def translate_code(assembler_code, offset, steps=False, debug=False):
-    # Validate offset (has to be a valid page)
-    cur_address = offset
-    #code = ''
-    code = {}
-    code[offset] = ''
-    line_no = 0
-    if debug:
-        print('line (address) instruction -> code')
-    #print(assembler_code)
-    for line in assembler_code:
-        line_no = line_no + 1
-        if not line:
-            continue
-        ret_str, new_offset = process_line(line, str(cur_address), debug)
-        if ret_str.startswith('Error'):
-            print(line_no, '(' + dec_to_hex(cur_address) + ')', line)
-            print('Error found:', ret_str)
-            return False
-        if debug or steps:
-            print(line_no, '(' + dec_to_hex(cur_address) + ')', line, '->', ret_str)
-        if new_offset:
-            offset = new_offset
-            cur_address = offset
-            code[offset] = ''
-        else:
-            code[offset] = code[offset] + ret_str
-            cur_address = cur_address + int(len(ret_str)/2)
-    # Resolve the label references
-    code_out = {}
-    for offset in code:
-        # Remove empty sequences
-        if not code[offset]:
-            if debug:
-                print('Removing empty sequence at offset=', offset)
-            continue
-        code_out[offset] = label_mgr.resolve_refs(code[offset], offset)
-        if code_out[offset].startswith('Error'):
-            print(code_out[offset])
-            return ''
-    return code_out
+def cache_key(lines, offset):
+    'Return the hash of what a translation depends on: the source with its included files, the instruction set and the offset'
+    digest = hashlib.sha256()
+    digest.update(('%d %d %r\n' % (CACHE_VERSION, offset, sorted(INST_SET.items()))).encode())
+    digest.update('\n'.join(lines).encode())
+    return digest.hexdigest()
 
 def write_code(outfile, code, debug=False):
-    code = format_code(code, ruler=False, debug=debug)
     if debug:
         print('Writing code:')
-        print(code)
-    code = code.split('\n')
+        print(format_code(code, ruler=False))
     try:
         with open(outfile, 'w') as out_file:
             line_no = 0
-            for line in code:
-                line_no = line_no + 1
-                out_file.write(line + '\n')
+            # A segment at a time, lines are padded so each one ends like the whole text would
+            for offset in code:
+                text = format_code({offset: code[offset]}, ruler=False)
+                if text:
+                    out_file.write(text + '\n')
+                    line_no = line_no + text.count('\n') + 1
         suffix = 's' if line_no > 1 else ''
         print('Wrote', line_no, 'line' + suffix + ' in file', outfile)
         return True
     except IOError:
-        print('Cannot open file', out_file)
+        print('Cannot open file', outfile)
+        return False
+
+def write_binary(outfile, code, full=False):
+    '''Write code as a raw image starting at address 0, unused bytes set to ff, up to the end of the code
+    or of the memory if full (written in place through a memory map)'''
+    try:
+        # Read access too, needed by the memory map
+        with open(outfile, 'w+b') as out_file:
+            if full:
+                out_file.write(b'\xff' * IMAGE_SIZE)
+                out_file.flush()
+                with mmap.mmap(out_file.fileno(), IMAGE_SIZE) as image:
+                    for offset in code:
+                        data = bytes.fromhex(code[offset])[:IMAGE_SIZE - offset]
+                        image[offset:offset + len(data)] = data
+                size = IMAGE_SIZE
+            else:
+                size = 0
+                for offset in sorted(code):
+                    data = bytes.fromhex(code[offset])
+                    if offset > size:
+                        out_file.seek(size)
+                        out_file.write(b'\xff' * (offset - size))
+                    else:
+                        out_file.seek(offset)
+                    out_file.write(data)
+                    size = max(size, offset + len(data))
+        print('Wrote', size, 'bytes in file', outfile)
+        return True
+    except IOError:
+        print('Cannot open file', outfile)
+        return False
+
+def hex_record(address, record_type, data=b''):
+    'Return an Intel HEX record line'
+    record = bytes([len(data), address >> 8, address & 0xff, record_type]) + data
+    return ':' + record.hex().upper() + '%02X\n' % (-sum(record) & 0xff)
+
+def write_hex(outfile, code):
+    'Write code as Intel HEX data records of HEX_RECORD bytes at most, then an end of file record'
+    try:
+        with open(outfile, 'w') as out_file:
+            records = 0
+            for offset in code:
+                data = bytes.fromhex(code[offset])
+                out_file.write(''.join([hex_record(offset + i, HEX_DATA, data[i:i + HEX_RECORD]) for i in range(0, len(data), HEX_RECORD)]))
+                records = records + (len(data) + HEX_RECORD - 1) // HEX_RECORD
+            out_file.write(hex_record(0, HEX_EOF))
+        print('Wrote', records + 1, 'records in file', outfile)
+        return True
+    except IOError:
+        print('Cannot open file', outfile)
         return False
 
+def write_output(outfile, code, out_format=None, full=False, debug=False):
+    'Write code in outfile as text, a binary image or Intel HEX, by default by the extension of outfile'
+    out_format = out_format or image_format(outfile) or 'text'
+    if out_format == 'bin':
+        return write_binary(outfile, code, full)
+    if out_format == 'hex':
+        return write_hex(outfile, code)
+    return write_code(outfile, code, debug)
+
+def image_format(file_name):
+    'Return the format of the code image file_name by its extension (bin or hex), None if it is not an image'
+    return IMAGE_FORMATS.get(os.path.splitext(file_name)[1].lower())
+
+def read_image(file_name):
+    '''Return the program in a raw (.bin) or Intel HEX (.hex) image as {address: bytes}
+    None if it cannot be read'''
+    try:
+        if image_format(file_name) == 'bin':
+            with open(file_name, 'rb') as input_file:
+                return {0: input_file.read()}
+        code = {}
+        segment = None
+        with open(file_name, 'r') as input_file:
+            for line_no, line in enumerate(input_file, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = bytes.fromhex(line[1:]) if line.startswith(':') else b''
+                except ValueError:
+                    record = b''
+                if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xff:
+                    print('Bad Intel HEX record at line', line_no, 'of file', file_name)
+                    return None
+                if record[3] == HEX_EOF:
+                    break
+                if record[3] != HEX_DATA:
+                    print('Unsupported Intel HEX record type', record[3], 'at line', line_no, 'of file', file_name)
+                    return None
+                address = record[1] << 8 | record[2]
+                # Consecutive records make a single segment
+                if segment is None or address != segment[0] + len(segment[1]):
+                    segment = (address, bytearray())
+                    code[address] = segment[1]
+                segment[1].extend(record[4:-1])
+        return code
+    except IOError:
+        print('Cannot open file', file_name)
+        return None
+
+def parse_code(lines):
+    'Return the program in lines written by write_code, None if they are not in that format'
+    code = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        match = CODE_LINE.match(line.strip())
+        if not match:
+            return None
+        code[int(match.group(1), 16)] = ''.join(match.group(2).split())
+    return code or None
+
+class Assembler():
+    'Translates programs, keeping the labels and aliases of its own'
+
+    def __init__(self, steps=False, debug=False, cache=True, optimize=False):
+        self.steps = steps
+        self.debug = debug
+        self.cache = cache
+        self.optimize = optimize
+        self.label_mgr = LabelManager(debug)
+        self.aliases = {}
+        # Cycles of each instruction, loaded when printing the translation
+        self.cost_model = None
+
+    def add_alias(self, name, value_str):
+        if self.debug:
+            print('Adding alias', '"' + name + '"', 'with value', '"' + value_str + '"')
+        self.aliases[name] = value_str
+        return True
+
+    def validate_params(self, command, at_address):
+        if len(command['params']) != len(INST_SET[command['instr']]['params']):
+            ret_str = 'Error: Parameter count mismatch for ' + command['instr']
+        else:
+            ret_str = ''
+            for (arg, param) in zip(command['params'], INST_SET[command['instr']]['params']):
+                if param == 'value':
+                    arg = validate_hex(arg, 2)
+                    ret_str = ret_str + arg
+                elif param == 'addr':
+                    arg = validate_hex(arg, 4)
+                    ret_str = ret_str + arg
+                elif param == 'addr_l':
+                    if self.label_mgr.label_exists(arg):
+                        arg = dec_to_hex(self.label_mgr.get_label_address(arg)) + 'h'
+                    elif LITERAL_ADDRESS.match(arg):
+                        arg = arg[:-1].lstrip('0').zfill(4) + 'h'
+                    else:
+                        arg = self.label_mgr.add_placeholder(arg, at_address) + 'h'
+                    arg = validate_hex(arg, 4)
+                    ret_str = ret_str + arg
+                elif param == 'page':
+                    arg = validate_hex(arg, 2)
+                    ret_str = ret_str + arg
+                else:
+                    ret_str = 'Error: Unrecognized parameter type'
+        return ret_str
+
+    def process_line(self, line, at_address):
+        ret_str = ''
+        new_offset = None
+        if line.startswith(SPEC_CMD_CHAR):
+            info = parse_line(line[1:])
+            if info['label']:
+                ret_str = 'Error: wrong special command syntax'
+            if info['instr'] == ALIAS_DEF:
+                if len(info['params']) < 2:
+                    ret_str = 'Error: ALIAS definition syntax'
+                else:
+                    self.add_alias(info['params'][0], ' '.join(info['params'][1:]))
+            elif info['instr'] == INC_FILE:
+                # Included by read_file
+                pass
+            elif info['instr'] == BASE_ADDR:
+                if len(info['params']) != 1:
+                    ret_str = 'Error: BASE_ADDR definition syntax'
+                else:
+                    offset_val = validate_hex(info['params'][0], 4)
+                    if offset_val.startswith('Error'):
+                        print(offset_val)
+                    else:
+                        new_offset = int(offset_val, 16)
+                        if self.debug:
+                            print('Setting new base address to', offset_val, '(', new_offset, ')')
+                        if not valid_offset(new_offset):
+                            ret_str = 'Error: BASE_ADDR has to be a multiple of 64 (40h)'
+            else:
+                ret_str = 'Error: Unrecognized special command'
+        else:
+            command = parse_line(line, self.aliases)
+            if command['label']:
+                if not self.label_mgr.add_label(command['label'], at_address):
+                    ret_str = 'Error: Duplicate label definition'
+            if command['instr']:
+                if command['instr'] not in INST_SET:
+                    ret_str = 'Error: Invalid instruction ' + command['instr']
+                else:
+                    ret_str = self.validate_params(command, at_address)
+                    if not ret_str.startswith('Error'):
+                        ret_str = INST_SET[command['instr']]['code'] + ret_str
+        return ret_str, new_offset
+
+    def costs(self):
+        'Return the cycles of each instruction, reading the microcode the first time (see estimator.py)'
+        if self.cost_model is None:
+            import estimator
+            self.cost_model = estimator.CostModel()
+        return self.cost_model
+
+    def cost_note(self, ret_str):
+        'Return the cycles taken by the instruction translated into ret_str'
+        if not ret_str:
+            return ''
+        return '; ' + self.costs().note(OPCODES[int(ret_str[:2], 16)][0])
+
+    def cost_report(self, code):
+        'Return the lines listing the blocks and loops of the code with their cycles'
+        import estimator
+        return estimator.CostEstimator(code, self.label_mgr.labels, self.costs()).report()
+
+    def translate_code(self, assembler_code, offset):
+        # Validate offset (has to be a valid page)
+        cur_address = offset
+        # Code of each segment started by the offset or a BASEADDR command
+        code = {}
+        code[offset] = segment = bytearray()
+        line_no = 0
+        if self.debug:
+            print('line (address) instruction -> code')
+        for line in assembler_code:
+            line_no = line_no + 1
+            if not line:
+                continue
+            ret_str, new_offset = self.process_line(line, cur_address)
+            if ret_str.startswith('Error'):
+                print(line_no, '(' + dec_to_hex(cur_address) + ')', line)
+                print('Error found:', ret_str)
+                return False
+            if self.debug or self.steps:
+                print(line_no, '(' + dec_to_hex(cur_address) + ')', line, '->', ret_str, self.cost_note(ret_str))
+            if new_offset:
+                offset = new_offset
+                cur_address = offset
+                code[offset] = segment = bytearray()
+            elif ret_str:
+                # Label references are filled in by resolve_refs
+                segment += bytes.fromhex(ret_str.replace(LabelManager.PL_H_STR, '0000'))
+                cur_address = offset + len(segment)
+        # Remove empty sequences
+        for offset in [offset for offset in code if not code[offset]]:
+            if self.debug:
+                print('Removing empty sequence at offset=', offset)
+            del code[offset]
+        if not code:
+            return {}
+        # Resolve the label references
+        error = self.label_mgr.resolve_refs(code)
+        if error:
+            print(error)
+            return ''
+        return {offset: code[offset].hex() for offset in code}
+
+    def translate_cached(self, lines, offset, cache_dir=CACHE_DIR):
+        '''Translate lines like translate_code, reusing the translation of the same source at the same offset
+        from cache_dir and restoring its labels. Translations are read again when printing them (steps or debug)'''
+        cache_file = os.path.join(cache_dir, cache_key(lines, offset))
+        if not (self.steps or self.debug):
+            try:
+                with open(cache_file, 'rb') as input_file:
+                    code, labels = marshal.loads(input_file.read())
+                self.label_mgr.labels.update(labels)
+                return code
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        code = self.translate_code(lines, offset)
+        if code:
+            # Replace the entry atomically, other assemblers may be reading it
+            temp_file = cache_file + '.' + str(os.getpid())
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(temp_file, 'wb') as out_file:
+                    out_file.write(marshal.dumps((code, self.label_mgr.labels)))
+                os.replace(temp_file, cache_file)
+            except OSError:
+                print('Cannot write assembler cache', cache_file)
+        return code
+
+    def assemble_file(self, infile, offset):
+        'Return the code of the program in infile, None if it has errors'
+        print('Reading program from file', infile)
+        lines = read_file(infile, self.debug)
+        if not lines:
+            return None
+        if self.optimize:
+            # Needs the microcode, see optimizer.py
+            import optimizer
+            peephole = optimizer.Optimizer()
+            lines = peephole.optimize(lines)
+            peephole.print_report()
+        # Translate into binary code
+        if self.cache:
+            code = self.translate_cached(lines, int(offset, 16))
+        else:
+            code = self.translate_code(lines, int(offset, 16))
+        return code or None
+
+    def translate_file(self, infile, offset):
+        'Return the code of the program in infile, exiting if it has errors'
+        code = self.assemble_file(infile, offset)
+        if not code:
+            print('Errors found, exiting')
+            sys.exit()
+        return code
+
+def expand_sources(patterns):
+    'Return the files matching the given names, glob patterns or folders'
+    sources = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+            sources.extend(sorted(name for name in names if os.path.isfile(name)))
+        else:
+            sources.extend(sorted(glob.glob(pattern)) or [pattern])
+    return sources
+
+def assemble_batch_file(infile, outdir, offset='0x0000', cache=True, out_format='text'):
+    'Assemble infile into a code file in outdir, return a dict with the file written or the errors found'
+    extension = '.txt' if out_format == 'text' else '.' + out_format
+    outfile = os.path.join(outdir, os.path.splitext(os.path.basename(infile))[0] + extension)
+    with contextlib.redirect_stdout(io.StringIO()) as messages:
+        code = Assembler(cache=cache).assemble_file(infile, offset)
+        done = code is not None and write_output(outfile, code, out_format)
+    if done:
+        return {'program': infile, 'outfile': outfile}
+    return {'program': infile, 'error': messages.getvalue().strip()}
+
+def assemble_batch(infiles, outdir, jobs=None, offset='0x0000', cache=True, out_format='text'):
+    '''Assemble every file of infiles into outdir in a pool of jobs processes (all cores if None)
+    Results are yielded in the same order, see assemble_batch_file'''
+    # Only needed by batch runs, importing it takes longer than assembling a program
+    from concurrent.futures import ProcessPoolExecutor
+    os.makedirs(outdir, exist_ok=True)
+    assemble = functools.partial(assemble_batch_file, outdir=outdir, offset=offset, cache=cache, out_format=out_format)
+    with ProcessPoolExecutor(jobs) as executor:
+        # Few large tasks, each process assembles programs back to back
+        yield from executor.map(assemble, infiles, chunksize=max(1, len(infiles) // (8 * (jobs or os.cpu_count() or 1))))
+
 def read_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('infile', nargs='?', type=str, default=None, help='Text file with assembler program')
     parser.add_argument('-o', '--outfile', type=str, default='out.txt', help='Text file with binary program')
+    parser.add_argument('-f', '--format', choices=['text', 'bin', 'hex'], default=None, help='Format of the output file: hex text, raw binary image or Intel HEX (by default from the extension of the file, text if unknown)')
+    parser.add_argument('--full-image', action='store_true', help='Write a binary image of the whole 64 KiB memory')
     parser.add_argument('-b', '--base', type=str, help='Specify starting address', default='0x0000', dest='offset')
     parser.add_argument('-d', '--debug', action='store_true', help='Print debug information')
     parser.add_argument('-p', '--print-code', action='store_true', help='Print generated code to screen')
     parser.add_argument('-s', '--step-trans', action='store_true', help='Print step-by-step code translation', dest='steps')
     parser.add_argument('-i', '--instruction-set', action='store_true', help='Print instruction set and exit')
+    parser.add_argument('-n', '--no-cache', action='store_true', help='Translate the program even if it was translated before')
+    parser.add_argument('-O', '--optimize', action='store_true', help='Rewrite instruction sequences into ones taking fewer cycles (see optimizer.py)')
     return parser.parse_args()
     
     # Print instruction set if needed and exit
@@ -480,25 +732,35 @@ def read_args():
         print('Errors found, exiting')
         sys.exit()
 
-def translate_file(infile, offset, steps=False, debug=False):
-
-    print('Reading program from file', infile)
-    lines = read_file(infile, debug)
-    if not lines:
-        print('Errors found, exiting')
-        sys.exit()
-
-    # Translate into binary code
-    code = translate_code(lines, int(offset, 16), steps, debug)
-    if not code:
-        print('Errors found, exiting')
-        sys.exit()
-    return code
-
-# Init handlers
-label_mgr = LabelManager()
-
-if __name__ == '__main__':
+def read_batch_args(argv):
+    parser = argparse.ArgumentParser(prog='assembler.py batch', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Assemble programs in parallel, writing a code file per program')
+    parser.add_argument('infiles', nargs='+', type=str, help='Assembler files, glob patterns or folders')
+    parser.add_argument('-o', '--outdir', type=str, default='out', help='Folder for the code files, named after the programs')
+    parser.add_argument('-b', '--base', type=str, help='Specify starting address', default='0x0000', dest='offset')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes, the number of cores if not given')
+    parser.add_argument('-n', '--no-cache', action='store_true', help='Translate the programs even if they were translated before')
+    parser.add_argument('-f', '--format', choices=['text', 'bin', 'hex'], default='text', help='Format of the code files: hex text, raw binary image or Intel HEX')
+    return parser.parse_args(argv)
+
+def batch_main(argv):
+    args = read_batch_args(argv)
+    infiles = expand_sources(args.infiles)
+    errors = 0
+    for result in assemble_batch(infiles, args.outdir, args.jobs, args.offset, not args.no_cache, args.format):
+        if 'error' in result:
+            errors = errors + 1
+            print(result['program'], 'has errors')
+            print(result['error'])
+        else:
+            print(result['program'], '->', result['outfile'])
+    print('Assembled', len(infiles) - errors, 'of', len(infiles), 'programs')
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__' and sys.argv[1:2] == ['batch']:
+    batch_main(sys.argv[2:])
+elif __name__ == '__main__':
     print('Microprocessor code assembler. Version 0.1')
 
     # Read command line arguments
@@ -511,15 +773,17 @@ if __name__ == '__main__':
         infile = input('Name of input file? ')
 
     # Translate assembler code in file
-    label_mgr.set_debug(args.debug)
-    code = translate_file(infile, args.offset, args.steps, args.debug)
+    assembler = Assembler(args.steps, args.debug, not args.no_cache, args.optimize)
+    code = assembler.translate_file(infile, args.offset)
 
     # Format and save
     code_len = sum([len(code[offset]) for offset in code])
     print('Code length is', code_len, 'chars')
-    ret = write_code(args.outfile, code, args.debug)
+    ret = write_output(args.outfile, code, args.format, args.full_image, args.debug)
     if args.print_code:
         print(format_code(code, ruler=True, debug=args.debug))
+    if args.print_code or args.steps:
+        print('\n'.join(assembler.cost_report(code)))
     if ret:
         print('Done!')
     else:
@@ -0,0 +1,216 @@
+'''
+Assembler and simulator benchmark
+'''
+
+import io
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import contextlib
+import subprocess
+import simulator as sim
+import assembler as asm
+import outputs as out
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+PROGRAMS = [os.path.join(ROOT_DIR, 'Assembly Files', '*'), os.path.join(BASE_DIR, 'test*.asm')]
+
+# Rates compared against the baseline, higher is better
+RATES = ['micro_ops_per_s', 'instructions_per_s', 'lines_per_s']
+# Times compared against the baseline, lower is better
+TIMES = ['startup_time']
+# Programs running for less time (s) are too noisy to compare on their own
+MIN_COMPARE_TIME = 0.01
+
+# Run in a fresh interpreter to time the simulator startup
+STARTUP_CODE = '''
+import time
+start = time.perf_counter()
+import simulator
+simulator.make_cpu({control_rom})
+print(time.perf_counter() - start)
+'''
+
+def list_programs():
+    programs = []
+    for pattern in PROGRAMS:
+        programs.extend(sorted(glob.glob(pattern)))
+    return programs
+
+def assemble(file_name):
+    'Return the program in file_name, None if it does not assemble'
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asm.Assembler(cache=False).assemble_file(file_name, '0x0000')
+
+def bench_program(file_name, repeat, max_cycles, control_rom):
+    'Return the best assembly and run times of a program out of repeat runs'
+    result = {'program': os.path.relpath(file_name, ROOT_DIR)}
+    assembly_time = float('inf')
+    for count in range(repeat):
+        start = time.perf_counter()
+        program = assemble(file_name)
+        assembly_time = min(assembly_time, time.perf_counter() - start)
+    if program is None:
+        result['error'] = 'Cannot assemble program'
+        return result
+    with contextlib.redirect_stdout(io.StringIO()):
+        lines = len(asm.read_file(file_name))
+    result['lines'] = lines
+    result['assembly_time'] = assembly_time
+    result['lines_per_s'] = lines / assembly_time
+    # The first run also translates the program into blocks, later runs reuse their code
+    run_time = float('inf')
+    for count in range(repeat + 1):
+        with contextlib.redirect_stdout(io.StringIO()):
+            cpu = sim.make_cpu(control_rom)
+            # Keep the outputs instead of printing them
+            cpu.set_output_sink(out.RingSink())
+            cpu.load_rom(program)
+            start = time.perf_counter()
+            try:
+                cpu.exec_prog(max_cycles)
+            except KeyError as error:
+                result['error'] = 'Undefined opcode ' + str(error)
+                return result
+            if count == 0:
+                result['first_run_time'] = time.perf_counter() - start
+            else:
+                run_time = min(run_time, time.perf_counter() - start)
+    result['halted'] = cpu.halted
+    result['cycles'] = cpu.cycles
+    result['instructions'] = cpu.instructions
+    result['run_time'] = run_time
+    result['micro_ops_per_s'] = cpu.cycles / run_time
+    result['instructions_per_s'] = cpu.instructions / run_time
+    return result
+
+def bench_startup(repeat, control_rom):
+    'Return the best time to import the simulator and build a CPU in a new process'
+    code = STARTUP_CODE.format(control_rom=control_rom)
+    best = float('inf')
+    for count in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=BASE_DIR, capture_output=True, text=True).stdout
+        best = min(best, float(output.split()[-1]))
+    return best
+
+def machine_info():
+    info = {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        pass
+    return info
+
+def run_benchmark(programs, repeat=3, max_cycles=2000000, control_rom=False):
+    results = {'machine': machine_info(), 'engine': 'control_rom' if control_rom else 'microcode',
+               'max_cycles': max_cycles, 'programs': []}
+    for file_name in programs:
+        results['programs'].append(bench_program(file_name, repeat, max_cycles, control_rom))
+    ran = [result for result in results['programs'] if 'error' not in result]
+    cycles = sum(result['cycles'] for result in ran)
+    instructions = sum(result['instructions'] for result in ran)
+    lines = sum(result['lines'] for result in ran)
+    run_time = sum(result['run_time'] for result in ran)
+    assembly_time = sum(result['assembly_time'] for result in ran)
+    results['total'] = {'cycles': cycles, 'instructions': instructions, 'lines': lines,
+                        'run_time': run_time, 'assembly_time': assembly_time,
+                        'micro_ops_per_s': cycles / run_time if run_time else 0,
+                        'instructions_per_s': instructions / run_time if run_time else 0,
+                        'lines_per_s': lines / assembly_time if assembly_time else 0,
+                        'startup_time': bench_startup(repeat, control_rom)}
+    return results
+
+def print_results(results):
+    print('Program                                    Lines   Lines/s     Cycles   Instrs  uOps/s      Instrs/s')
+    for result in results['programs']:
+        name = result['program'].ljust(40)
+        if 'error' in result:
+            print(name, result['error'])
+            continue
+        print(name, str(result['lines']).rjust(7), str(int(result['lines_per_s'])).rjust(9),
+              str(result['cycles']).rjust(10), str(result['instructions']).rjust(8),
+              str(int(result['micro_ops_per_s'])).rjust(11), str(int(result['instructions_per_s'])).rjust(11),
+              '' if result['halted'] else '(cycle limit)')
+    total = results['total']
+    print('Total', str(total['lines']).rjust(42), str(int(total['lines_per_s'])).rjust(9),
+          str(total['cycles']).rjust(10), str(total['instructions']).rjust(8),
+          str(int(total['micro_ops_per_s'])).rjust(11), str(int(total['instructions_per_s'])).rjust(11))
+    print('Startup time', round(total['startup_time'] * 1000, 1), 'ms')
+
+def compare_results(results, baseline, threshold):
+    'Print the changes from baseline and return the names of the metrics worse by more than threshold percent'
+    regressions = []
+    old_programs = {result['program']: result for result in baseline['programs']}
+    pairs = []
+    # Totals only mean the same with the same programs
+    if sorted(old_programs) == sorted(result['program'] for result in results['programs']):
+        pairs.append(('total', results['total'], baseline['total'], RATES + TIMES))
+    else:
+        print('Programs differ from the baseline, comparing each program on its own')
+    for result in results['programs']:
+        old = old_programs.get(result['program'], {})
+        if min(result.get('run_time', 0), old.get('run_time', 0)) >= MIN_COMPARE_TIME:
+            pairs.append((result['program'], result, old, ['micro_ops_per_s', 'instructions_per_s']))
+    for name, new, old, metrics in pairs:
+        for metric in metrics:
+            if not new.get(metric) or not old.get(metric):
+                continue
+            if metric in RATES:
+                change = (new[metric] / old[metric] - 1) * 100
+            else:
+                change = (old[metric] / new[metric] - 1) * 100
+            if name == 'total' or change < -threshold:
+                print(name, metric, 'changed by', '%+.1f%%' % change, '(faster)' if change >= 0 else '(slower)')
+            if change < -threshold:
+                regressions.append(name + ' ' + metric)
+    return regressions
+
+def read_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('programs', nargs='*', type=str, help='Programs to run, all the bundled ones if not given')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='Runs of each program, the best one is reported')
+    parser.add_argument('-c', '--max-cycles', type=int, default=2000000, help='Micro instructions run before stopping a program')
+    parser.add_argument('-r', '--control-rom', action='store_true', help='Execute the control ROM image instead of the microcode header')
+    parser.add_argument('-o', '--outfile', type=str, default=None, help='JSON file to save the results in')
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='JSON file with results to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=5.0, help='Slowdown (percent) reported as a regression')
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    return args
+
+if __name__ == '__main__':
+    print('Microprocessor benchmark. Version 0.1')
+
+    args = read_args()
+    results = run_benchmark(args.programs or list_programs(), args.repeat, args.max_cycles, args.control_rom)
+    print_results(results)
+
+    if args.outfile:
+        with open(args.outfile, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+        print('Wrote results in file', args.outfile)
+
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r') as input_file:
+                baseline = json.load(input_file)
+        except IOError:
+            print('Cannot open file', args.baseline)
+            sys.exit(2)
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print('Regressions over', str(args.threshold) + '%:', ', '.join(regressions))
+            sys.exit(1)
+        print('No regressions over', str(args.threshold) + '%')
@@ -0,0 +1,184 @@
+'''
+CPU disassembler
+Turns code images and assembler output files back into assembler source, with labels at the jump targets
+'''
+
+import sys
+import argparse
+import assembler as asm
+
+# Bytes read at a time from binary images
+PAGE = 256
+# Unused ROM bytes (ff) are NOPs, runs of them are left out or skipped with @BASEADDR (a multiple of ROW)
+ROW = 64
+NOP = 0xff
+# Name of the label synthesized for a jump target
+LABEL = 'L_%04x'
+# Bytes of each instruction by code, unknown codes take a byte
+SIZES = [asm.OPCODES[code][2] if code in asm.OPCODES else 1 for code in range(256)]
+
+def read_chunks(file_name):
+    '''Yield the (address, bytes) chunks of the code in file_name, in address order
+    Binary images are read a page at a time, Intel HEX and code files written by the assembler whole'''
+    if asm.image_format(file_name) == 'bin':
+        with open(file_name, 'rb') as input_file:
+            address = 0
+            for page in iter(lambda: input_file.read(PAGE), b''):
+                yield address, page
+                address = address + len(page)
+        return
+    if asm.image_format(file_name) == 'hex':
+        code = asm.read_image(file_name)
+    else:
+        with open(file_name, 'r') as input_file:
+            code = asm.parse_code([line.rstrip() for line in input_file])
+    if code is None:
+        raise ValueError('not a code file')
+    yield from code_chunks(code)
+
+def code_chunks(code):
+    'Yield the (address, bytes) chunks of an {address: code} program, code as a hex string or bytes'
+    for address in sorted(code):
+        data = code[address]
+        yield address, bytes.fromhex(data) if isinstance(data, str) else bytes(data)
+
+def decode(chunks):
+    '''Yield (address, opcode, operand bytes) for every instruction in the (address, bytes) chunks
+    Instructions can go on in the next chunk when it follows on; the opcode is None for the bytes
+    of an instruction cut short by a gap or the end of the code'''
+    pending = b''
+    pending_address = 0
+    for address, data in chunks:
+        if pending:
+            if address == pending_address + len(pending):
+                data = pending + data
+                address = pending_address
+            else:
+                yield pending_address, None, pending
+            pending = b''
+        pos = 0
+        end = len(data)
+        while pos < end:
+            size = SIZES[data[pos]]
+            if pos + size > end:
+                pending = data[pos:]
+                pending_address = address + pos
+                break
+            yield address + pos, data[pos], data[pos + 1:pos + size]
+            pos = pos + size
+    if pending:
+        yield pending_address, None, pending
+
+def jump_targets(chunks):
+    'Return the set of addresses the jumps in the chunks go to'
+    targets = set()
+    for address, opcode, operands in decode(chunks):
+        if opcode in asm.OPCODES and 'addr_l' in asm.OPCODES[opcode][1]:
+            targets.add(operands[0] << 8 | operands[1])
+    return targets
+
+def label_targets(chunks):
+    '''Return the addresses the jumps in the chunks go to, as the set of those starting an instruction,
+    which can be labeled, and the set of the others (inside an instruction or outside the code)'''
+    targets = set()
+    starts = set()
+    for address, opcode, operands in decode(chunks):
+        if opcode is not None:
+            starts.add(address)
+        if opcode in asm.OPCODES and 'addr_l' in asm.OPCODES[opcode][1]:
+            targets.add(operands[0] << 8 | operands[1])
+    return targets & starts, targets - starts
+
+def literal_address(address):
+    'Return a jump address as a hex constant, starting with a digit as the assembler needs (see asm.LITERAL_ADDRESS)'
+    text = '%04xh' % address
+    return text if text[0].isdigit() else '0' + text
+
+def format_instr(opcode, operands, labels):
+    'Return the source of an instruction, jump targets by their label or their address if they have none'
+    name, params, size = asm.OPCODES[opcode]
+    items = [name]
+    pos = 0
+    for param in params:
+        if asm.PARAM_SIZE[param] == 1:
+            items.append('%02xh' % operands[pos])
+        else:
+            address = operands[pos] << 8 | operands[pos + 1]
+            items.append(labels.get(address, literal_address(address)) if param == 'addr_l' else '%04xh' % address)
+        pos = pos + asm.PARAM_SIZE[param]
+    return ' '.join(items)
+
+def disassemble(chunks, targets, names=None, addresses=False, others=()):
+    '''Yield the lines of the assembler source of the code in the (address, bytes) chunks
+    targets are the addresses to label, named from the {address: name} names or L_<address>, others
+    the jump targets that cannot be labeled (see label_targets), jumps to them are written with the address.
+    Unused (ff) bytes are left out, code that cannot be written in source is left in comments'''
+    labels = {address: LABEL % address for address in targets}
+    labels.update(names or {})
+    placed = set()
+    inside = set()
+    # Address the assembler writes the next instruction at
+    cur_address = 0
+    for address, opcode, operands in decode(chunks):
+        if opcode == NOP and address not in labels:
+            continue
+        if address != cur_address:
+            # NOPs up to the instruction, or a new base address if it is shorter
+            row = address - address % ROW
+            if address - row + 1 < address - cur_address:
+                yield '@BASEADDR %04xh' % row
+                cur_address = row
+            for nop in range(cur_address, address):
+                yield ' NOP' + ('  ; %04x: ff' % nop if addresses else '')
+            cur_address = address
+        if address in labels:
+            yield labels[address] + ':'
+            placed.add(address)
+        if opcode is None:
+            yield '; %04x: %s incomplete instruction' % (address, operands.hex())
+            continue
+        if opcode not in asm.OPCODES:
+            yield '; %04x: %02x unknown instruction' % (address, opcode)
+            continue
+        comment = '  ; %04x: %02x%s' % (address, opcode, operands.hex()) if addresses else ''
+        yield ' ' + format_instr(opcode, operands, labels) + comment
+        cur_address = address + 1 + len(operands)
+        for target in range(address + 1, cur_address):
+            if target in labels or target in others:
+                yield '; jump target %04x points inside the instruction at %04x' % (target, address)
+                inside.add(target)
+    for address in sorted((set(targets) | set(others)) - placed - inside):
+        yield '; jump target %04x points outside the code' % address
+
+def disassemble_code(code, names=None, addresses=False):
+    'Return the source lines of an {address: code} program, see disassemble'
+    targets, others = label_targets(code_chunks(code))
+    return list(disassemble(code_chunks(code), targets, names, addresses, others))
+
+def read_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Write the assembler source of a code image or code file written by assembler.py')
+    parser.add_argument('infile', type=str, help='Binary image (.bin), Intel HEX (.hex) or code file')
+    parser.add_argument('-o', '--outfile', type=str, default=None, help='File to write the source in, printed if not given')
+    parser.add_argument('-a', '--addresses', action='store_true', help='Add the address and bytes of each instruction in a comment')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = read_args()
+    try:
+        # A pass to find the jump targets, another one to write the source
+        targets, others = label_targets(read_chunks(args.infile))
+        out_file = open(args.outfile, 'w') if args.outfile else sys.stdout
+        try:
+            lines = 0
+            for line in disassemble(read_chunks(args.infile), targets, addresses=args.addresses, others=others):
+                out_file.write(line + '\n')
+                lines = lines + 1
+        finally:
+            if args.outfile:
+                out_file.close()
+    except (IOError, ValueError) as error:
+        print('Cannot read code file', args.infile, '(' + str(error) + ')')
+        sys.exit(1)
+    if args.outfile:
+        print('Wrote', lines, 'lines in file', args.outfile)
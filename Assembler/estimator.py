@@ -0,0 +1,299 @@
+'''
+Static cycle cost estimator
+Counts the cycles of every instruction of a program from the microcode header (its micro instructions
+and the CLR step ending it), splits the code in basic blocks and reports the cycles of each block and
+of each loop iteration
+'''
+
+import io
+import sys
+import argparse
+import contextlib
+import assembler as asm
+import simulator as sim
+import disassembler as dis
+
+# Flags set in each microcode version
+VERSION_FLAGS = {'base': 'none', 'flaggedCarry': 'C', 'flaggedEqual': 'E', 'flaggedBoth': 'C+E'}
+# Signals of micro instructions loading the program counter, and halting
+PC_SIGNALS = ('PLI', 'PHI')
+HALT_SIGNAL = 'HLT'
+# Immediate dominator of the entry blocks
+ROOT = -1
+
+class CostModel():
+    'Cycles taken by each instruction, with its jump taken or not, counting the CLR step ending it'
+
+    def __init__(self, microcode=None):
+        if microcode is None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                microcode = sim.load_microcode(sim.SRC_MICROCODE)
+        sequences = [seq for version in sim.MICRO_VERSIONS for seq in microcode[version].values()]
+        # Micro instructions of the fetch every instruction starts with (PO & II, PIN)
+        self.fetch = len(sequences[0])
+        for seq in sequences:
+            while seq[:self.fetch] != sequences[0][:self.fetch]:
+                self.fetch = self.fetch - 1
+        # Cycles by instruction name when it goes on with the next instruction and when it loads the PC,
+        # None if it never does, and the flags the PC is loaded with
+        self.cycles = {}
+        self.taken = {}
+        self.taken_flags = {}
+        self.halts = set()
+        for name, info in asm.INST_SET.items():
+            if info['code'] not in microcode['base']:
+                continue
+            cycles = []
+            taken = []
+            flags = []
+            for version in sim.MICRO_VERSIONS:
+                seq = microcode[version][info['code']]
+                signals = [signal.strip() for step in seq for signal in step.split('&')]
+                if any(signal in PC_SIGNALS for signal in signals):
+                    taken.append(len(seq) + sim.clear_cycles(seq))
+                    flags.append(VERSION_FLAGS[version])
+                else:
+                    cycles.append(len(seq) + sim.clear_cycles(seq))
+                if HALT_SIGNAL in signals:
+                    self.halts.add(name)
+            self.cycles[name] = max(cycles) if cycles else None
+            self.taken[name] = max(taken) if taken else None
+            self.taken_flags[name] = flags
+
+    def note(self, name):
+        'Return the cost of an instruction as text'
+        if name not in self.cycles:
+            return 'no microcode'
+        if self.taken[name] is None:
+            return str(self.cycles[name]) + ' cycles'
+        if self.cycles[name] is None:
+            return str(self.taken[name]) + ' cycles'
+        return '%d cycles, %d jumping (flags %s)' % (self.cycles[name], self.taken[name], ', '.join(self.taken_flags[name]))
+
+def range_text(low, high):
+    return str(low) if low == high else str(low) + '-' + str(high)
+
+class CostEstimator():
+    'Basic blocks, loops and their cycles of a translated program'
+
+    def __init__(self, code, labels=None, model=None):
+        self.model = model or CostModel()
+        self.names = {address: name for name, address in (labels or {}).items()}
+        self.instrs = [(address, opcode, operands) for address, opcode, operands in dis.decode(dis.code_chunks(code))]
+        self.blocks = {}
+        self.loops = []
+        self.build_blocks(code)
+        self.find_loops()
+
+    def name(self, opcode):
+        return asm.OPCODES[opcode][0] if opcode in asm.OPCODES else None
+
+    def build_blocks(self, code):
+        '''Split the instructions in blocks, run from their first instruction to their last one.
+        Each block has its edges: (next block, cycles of the block on the way there, 'jump' or 'next')
+        and the fewest and most cycles it takes'''
+        model = self.model
+        targets = dis.jump_targets(dis.code_chunks(code))
+        leaders = set(code) | targets
+        for address, opcode, operands in self.instrs:
+            name = self.name(opcode)
+            if name not in model.cycles or name in model.halts or model.taken[name] is not None:
+                leaders.add(address + 1 + len(operands))
+        block = None
+        for address, opcode, operands in self.instrs:
+            if address in leaders or block is None:
+                block = {'start': address, 'instrs': [], 'edges': [], 'returns': False}
+                self.blocks[address] = block
+            block['instrs'].append((address, opcode, operands))
+        # The calls (PUSHX) push the address to return to, it is reached through RET
+        self.entries = {min(code)} if code else set()
+        for address, opcode, operands in self.instrs:
+            if self.name(opcode) == 'PUSHX':
+                self.entries.add(operands[0] << 8 | operands[1])
+        for block in self.blocks.values():
+            address, opcode, operands = block['instrs'][-1]
+            name = self.name(opcode)
+            block['end'] = address
+            # Cycles of the instructions before the last one, they always go on with the next one
+            before = sum(model.cycles.get(self.name(instr[1])) or 0 for instr in block['instrs'][:-1])
+            if name not in model.cycles or name in model.halts:
+                block['cycles'] = (before + (model.cycles.get(name) or 0),) * 2
+                continue
+            next_address = address + 1 + len(operands)
+            if model.cycles[name] is not None and next_address in self.blocks:
+                block['edges'].append((next_address, before + model.cycles[name], 'next'))
+            if model.taken[name] is not None:
+                if 'addr_l' in asm.OPCODES[opcode][1]:
+                    block['edges'].append((operands[0] << 8 | operands[1], before + model.taken[name], 'jump'))
+                else:
+                    # Returns load the PC from the stack
+                    block['returns'] = True
+            costs = [cycles for target, cycles, kind in block['edges']]
+            if model.taken[name] is not None and block['returns']:
+                costs.append(before + model.taken[name])
+            if model.cycles[name] is not None and next_address not in self.blocks:
+                costs.append(before + model.cycles[name])
+            block['cycles'] = (min(costs), max(costs)) if costs else (before, before)
+
+    def dominators(self):
+        '''Set the immediate dominator of each block, the last block every path from an entry to it goes through
+        (ROOT for entries), and return the predecessors of each block'''
+        starts = sorted(self.blocks)
+        preds = {start: [] for start in starts}
+        for block in self.blocks.values():
+            for target, cycles, kind in block['edges']:
+                if target in preds:
+                    preds[target].append(block['start'])
+        # Depth first from the entries, then from the loops nothing reaches, for the reverse postorder
+        roots = set()
+        order = []
+        seen = set()
+        for root in [start for start in starts if start in self.entries or not preds[start]] + starts:
+            if root in seen:
+                continue
+            roots.add(root)
+            seen.add(root)
+            stack = [(root, iter(self.blocks[root]['edges']))]
+            while stack:
+                start, edges = stack[-1]
+                for target, cycles, kind in edges:
+                    if target in preds and target not in seen:
+                        seen.add(target)
+                        stack.append((target, iter(self.blocks[target]['edges'])))
+                        break
+                else:
+                    order.append(start)
+                    stack.pop()
+        order.reverse()
+        self.order = {start: index for index, start in enumerate(order)}
+        self.order[ROOT] = -1
+        self.idom = {start: None for start in order}
+        self.idom[ROOT] = ROOT
+        for root in roots:
+            self.idom[root] = ROOT
+        changed = True
+        while changed:
+            changed = False
+            for start in order:
+                if start in roots:
+                    continue
+                idom = None
+                for pred in preds[start]:
+                    if self.idom[pred] is not None:
+                        idom = pred if idom is None else self.common_dominator(pred, idom)
+                if idom != self.idom[start]:
+                    self.idom[start] = idom
+                    changed = True
+        return preds
+
+    def common_dominator(self, first, second):
+        while first != second:
+            while self.order[first] > self.order[second]:
+                first = self.idom[first]
+            while self.order[second] > self.order[first]:
+                second = self.idom[second]
+        return first
+
+    def dominates(self, first, second):
+        'True when every path to block second goes through block first'
+        while second != ROOT:
+            if second == first:
+                return True
+            second = self.idom[second]
+        return False
+
+    def find_loops(self):
+        'Find the loops (a header reached back from blocks it dominates) with the cycles of an iteration'
+        preds = self.dominators()
+        latches = {}
+        for block in self.blocks.values():
+            for target, cycles, kind in block['edges']:
+                if target in self.blocks and self.dominates(target, block['start']):
+                    latches.setdefault(target, []).append(block['start'])
+        for header in sorted(latches):
+            body = {header}
+            stack = list(latches[header])
+            while stack:
+                start = stack.pop()
+                if start not in body:
+                    body.add(start)
+                    stack.extend(preds[start])
+            low, high = self.iteration_cycles(header, body)
+            self.loops.append({'header': header, 'body': sorted(body), 'cycles': (low, high),
+                               'inner': sorted(other for other in latches if other != header and other in body)})
+
+    def iteration_cycles(self, header, body):
+        '''Return the fewest and most cycles from header back to it, staying in body
+        Inner loops are gone through once, without going back to their header'''
+        # Paths through the body without going back to a header can be walked in topological order
+        inside = {start: [(target, cycles) for target, cycles, kind in self.blocks[start]['edges']
+                          if target in body and not self.dominates(target, start)] for start in body}
+        count = {start: 0 for start in body}
+        for start in body:
+            for target, cycles in inside[start]:
+                count[target] = count[target] + 1
+        order = []
+        ready = [start for start in body if not count[start]]
+        while ready:
+            start = ready.pop()
+            order.append(start)
+            for target, cycles in inside[start]:
+                count[target] = count[target] - 1
+                if not count[target]:
+                    ready.append(target)
+        # Cycles from each block back to the header
+        back = {}
+        for start in reversed(order):
+            costs = [(cycles, cycles) for target, cycles, kind in self.blocks[start]['edges'] if target == header]
+            costs.extend((cycles + back[target][0], cycles + back[target][1]) for target, cycles in inside[start] if target in back)
+            if costs:
+                back[start] = (min(low for low, high in costs), max(high for low, high in costs))
+        return back.get(header, (0, 0))
+
+    def label(self, address):
+        return self.names.get(address, dis.LABEL % address)
+
+    def format_instr(self, opcode, operands):
+        if opcode not in asm.OPCODES:
+            return '%02x unknown instruction' % opcode if opcode is not None else 'incomplete instruction'
+        return dis.format_instr(opcode, operands, self.names)
+
+    def report(self):
+        'Return the lines listing the blocks with the cost of each instruction, then the loops'
+        model = self.model
+        lines = ['Cycle costs (clocks, counting the %d of the instruction fetch and the CLR step ending each instruction)' % model.fetch]
+        for start in sorted(self.blocks):
+            block = self.blocks[start]
+            low, high = block['cycles']
+            edges = ', '.join('%s %s (%d)' % (kind, self.label(target), cycles) for target, cycles, kind in block['edges'])
+            ends = ' returns' if block['returns'] else ''
+            if not block['edges'] and not block['returns']:
+                ends = ' stops'
+            lines.append('Block %04x-%04x %s: %d instructions, %s cycles%s%s' % (
+                start, block['end'], self.label(start), len(block['instrs']), range_text(low, high),
+                ' -> ' + edges if edges else '', ends))
+            for address, opcode, operands in block['instrs']:
+                name = self.name(opcode)
+                lines.append('  %04x %-20s %s' % (address, self.format_instr(opcode, operands), model.note(name) if name else ''))
+        for loop in self.loops:
+            low, high = loop['cycles']
+            inner = ', inner loops at ' + ', '.join(self.label(header) for header in loop['inner']) + ' counted once' if loop['inner'] else ''
+            lines.append('Loop at %s: %d blocks, %s cycles per iteration%s' % (
+                self.label(loop['header']), len(loop['body']), range_text(low, high), inner))
+        return lines
+
+def read_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Print the cycles taken by the blocks and loops of an assembler program')
+    parser.add_argument('infile', type=str, help='Text file with assembler program')
+    parser.add_argument('-b', '--base', type=str, help='Specify starting address', default='0x0000', dest='offset')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = read_args()
+    assembler = asm.Assembler()
+    code = assembler.assemble_file(args.infile, args.offset)
+    if not code:
+        print('Errors found, exiting')
+        sys.exit(1)
+    print('\n'.join(CostEstimator(code, assembler.label_mgr.labels).report()))
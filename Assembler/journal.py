@@ -0,0 +1,52 @@
+'''
+Execution journal
+Records what every micro instruction changed in the CPU so that a run can be stepped backwards
+'''
+
+import collections
+
+# Micro instructions kept by default, older ones are dropped
+JOURNAL_SIZE = 200000
+
+class Journal():
+    'Bounded record of the CPU fields and RAM byte each micro instruction changed, with their old values'
+
+    def __init__(self, fields, size=JOURNAL_SIZE):
+        self.fields = fields
+        self.size = size
+        # Entries are (more, changes, ram): more is False for the step loading the next instruction,
+        # changes the old values as (index in fields, value) pairs and ram the (address, value) overwritten
+        self.entries = collections.deque(maxlen=size)
+
+    def record(self, cpu):
+        'Run a micro instruction of cpu, recording what it changed'
+        fields = self.fields
+        before = [getattr(cpu, field) for field in fields]
+        # RAM is only written at the RAM pointer, which cannot change in the same micro instruction
+        ram_ptr = cpu.ram_ptr
+        ram_value = cpu.ram[ram_ptr]
+        more = cpu.step_microinstr()
+        changes = tuple((index, value) for index, value in enumerate(before) if getattr(cpu, fields[index]) != value)
+        ram = (ram_ptr, ram_value) if cpu.ram[ram_ptr] != ram_value else None
+        self.entries.append((more, changes, ram))
+        return more
+
+    def rewind(self, cpu):
+        'Undo the last micro instruction recorded, return False when there is none'
+        if not self.entries:
+            return False
+        more, changes, ram = self.entries.pop()
+        fields = self.fields
+        for index, value in changes:
+            setattr(cpu, fields[index], value)
+        if ram:
+            cpu.ram[ram[0]] = ram[1]
+            cpu.ram_view.mark(ram[0])
+        return True
+
+    def at_instr_start(self):
+        'True when the last step recorded loaded an instruction, or there is none left'
+        return not self.entries or not self.entries[-1][0]
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,226 @@
+'''
+Lockstep CPU Emulator
+Runs many instances of the same program, each with its own registers and RAM
+'''
+
+import re
+import time
+import argparse
+import numpy as np
+import simulator as sim
+import assembler as asm
+
+# Micro-op sources working on arrays holding the state of a group of instances
+# RAM is stored inverted so that its untouched pages are never allocated (see LockstepCpu.reset)
+LOCKSTEP_OUT = dict(sim.MICRO_OUT, RO=['bus = (ram[rows, rp] ^ 0xff).astype(int)'], HLT=['halted = True'])
+LOCKSTEP_IN = dict(sim.MICRO_IN, RI=['ram[rows, rp] = bus ^ 0xff'], OI=['o = bus', 'outputs.append((rows, bus))'])
+LOCKSTEP_LOCALS = dict(sim.CPU_LOCALS, o='reg_o', halted='halted')
+# Locals shared by all the instances instead of indexed by rows
+LOCKSTEP_SHARED = {'ram': 'ram', 'rom': 'rom'}
+
+def handler_source(body, cycles):
+    'Return the source of a function running body on the instances in rows'
+    text = '\n'.join(body)
+    used = [local for local in LOCKSTEP_LOCALS if re.search(r'\b' + local + r'\b', text)]
+    assigned = set(match.group(1) for match in (re.match(r'(\w+) = ', line) for line in body) if match)
+    lines = ['def handler(cpu, rows):']
+    for local in used:
+        if local in LOCKSTEP_SHARED:
+            lines.append('    ' + local + ' = cpu.' + LOCKSTEP_SHARED[local])
+        else:
+            lines.append('    ' + local + ' = cpu.' + LOCKSTEP_LOCALS[local] + '[rows]')
+    if 'outputs' in text:
+        lines.append('    outputs = cpu.output_log')
+    lines.extend('    ' + line for line in body)
+    lines.extend('    cpu.' + LOCKSTEP_LOCALS[local] + '[rows] = ' + local for local in used if local in assigned)
+    lines.append('    cpu.cycles[rows] += ' + str(cycles))
+    return '\n'.join(lines)
+
+def make_handler(seq):
+    'Compile a handler running a microcode sequence on a group of instances'
+    body, cycles, pc, end = sim.micro_source(seq, out_source=LOCKSTEP_OUT, in_source=LOCKSTEP_IN)
+    namespace = {}
+    exec(compile(handler_source(body, cycles), '<lockstep>', 'exec'), namespace)
+    return namespace['handler']
+
+class LockstepCpu():
+    '''CPU Simulator running count instances of the same ROM in lockstep
+    Every step runs one instruction on all the instances, grouping them by microcode sequence
+    Registers (reg_a, ..., pc_ptr, ram_ptr) and flags are arrays with an entry per instance,
+    set them (and RAM with set_ram) after load_rom to sweep initial states'''
+
+    DEFAULT_ROM = sim.Cpu.DEFAULT_ROM
+    DEFAULT_RAM = sim.Cpu.DEFAULT_RAM
+    MEM_SIZE = sim.Cpu.MEM_SIZE
+    NO_OP_MAX = sim.Cpu.NO_OP_MAX
+
+    def __init__(self, microcode, count):
+        self.count = count
+        self.rows = np.arange(count)
+        self.compile_microcode(microcode)
+        # Wide enough to shift the bytes read into the high byte of an address
+        self.rom = np.full(self.MEM_SIZE, self.DEFAULT_ROM, np.int32)
+        self.reset()
+
+    def compile_microcode(self, microcode):
+        'Number every distinct microcode sequence and compile its handler'
+        seqs = {}
+        # Undefined opcodes are left as -1
+        self.seq_table = np.full((len(sim.MICRO_VERSIONS), 256), -1, np.int16)
+        for flags, version in enumerate(sim.MICRO_VERSIONS):
+            for code, seq in microcode[version].items():
+                self.seq_table[flags, int(code, 16)] = seqs.setdefault(tuple(seq), len(seqs))
+        self.handlers = [make_handler(seq) for seq in seqs]
+
+    def reset(self):
+        count = self.count
+        self.reg_a = np.zeros(count, np.int32)
+        self.reg_b = np.zeros(count, np.int32)
+        self.reg_c = np.zeros(count, np.int32)
+        self.reg_d = np.zeros(count, np.int32)
+        self.reg_o = np.zeros(count, np.int32)
+        self.bus = np.zeros(count, np.int32)
+        self.ram_low = np.zeros(count, np.int32)
+        self.ram_high = np.zeros(count, np.int32)
+        self.ram_ptr = np.zeros(count, np.int32)
+        # A fresh zeroed array only takes memory for the pages written to
+        self.ram = np.zeros((count, self.MEM_SIZE), np.uint8)
+        self.pc_low = np.zeros(count, np.int32)
+        self.pc_high = np.zeros(count, np.int32)
+        self.pc_ptr = np.zeros(count, np.int32)
+        self.carry_flag = np.zeros(count, bool)
+        self.equal_flag = np.zeros(count, bool)
+        self.halted = np.zeros(count, bool)
+        self.cycles = np.zeros(count, np.int64)
+        # Cycle at which each instance stopped, -1 while running
+        self.halt_cycles = np.full(count, -1, np.int64)
+        # Instances stopped by an opcode missing in the microcode
+        self.undefined = np.zeros(count, bool)
+        self.no_op_count = np.zeros(count, np.int32)
+        self.output_log = []
+        self.init_microcode()
+
+    def init_microcode(self):
+        self.seq = np.zeros(self.count, np.int16)
+        self.next_instr(np.flatnonzero(self.halt_cycles < 0), False)
+
+    def load_rom(self, program):
+        for address, code in program.items():
+            if isinstance(code, str):
+                code = bytes.fromhex(code)
+            self.rom[address:address + len(code)] = np.frombuffer(code, np.uint8)
+        self.init_microcode()
+
+    def get_ram(self, address):
+        'Return the RAM byte at address of every instance'
+        return self.ram[:, address] ^ 0xff
+
+    def set_ram(self, address, values):
+        'Set the RAM bytes starting at address, values has one row per instance'
+        values = np.asarray(values, np.uint8)
+        if values.ndim == 1:
+            values = values[:, None]
+        self.ram[:, address:address + values.shape[1]] = values ^ 0xff
+
+    def set_pc(self, values):
+        self.pc_ptr[:] = values
+        self.pc_high[:] = self.pc_ptr >> 8
+        self.pc_low[:] = self.pc_ptr & 0xff
+        self.init_microcode()
+
+    def next_instr(self, rows, fuse=True):
+        'Select the microcode of the instruction at pc for the given instances'
+        instr = self.rom[self.pc_ptr[rows]]
+        if fuse:
+            # Fuse to avoid infinite loops, as in Cpu.next_instr
+            no_op = instr == 0xff
+            self.no_op_count[rows] = np.where(no_op, self.no_op_count[rows] + 1, 0)
+            self.halted[rows] |= self.no_op_count[rows] > self.NO_OP_MAX
+        seq = self.seq_table[(self.equal_flag[rows] << 1) | self.carry_flag[rows], instr]
+        self.seq[rows] = seq
+        stop = self.halted[rows] | (seq < 0)
+        if stop.any():
+            stopped = rows[stop]
+            self.undefined[stopped] = seq[stop] < 0
+            self.halted[stopped] = True
+            self.halt_cycles[stopped] = self.cycles[stopped]
+
+    def exec_instr(self, rows):
+        'Run the current instruction of the given instances'
+        seq = self.seq[rows]
+        groups = np.bincount(seq, minlength=len(self.handlers))
+        present = np.flatnonzero(groups)
+        if len(present) == 1:
+            self.handlers[present[0]](self, rows)
+        else:
+            # Sort the instances to get the rows running each sequence
+            order = rows[np.argsort(seq, kind='stable')]
+            start = 0
+            for index, end in zip(present, np.cumsum(groups[present])):
+                self.handlers[index](self, order[start:end])
+                start = end
+        self.next_instr(rows)
+
+    def exec_one_instr(self):
+        self.exec_instr(np.flatnonzero(self.halt_cycles < 0))
+
+    def exec_prog(self, max_cycles=None):
+        '''Run every instance until halted, or until the instruction running when it
+        has executed max_cycles more micro instructions is done'''
+        rows = np.flatnonzero(self.halt_cycles < 0)
+        if max_cycles is None:
+            while len(rows):
+                self.exec_instr(rows)
+                rows = rows[self.halt_cycles[rows] < 0]
+        else:
+            limit = self.cycles + max_cycles
+            while len(rows):
+                self.exec_instr(rows)
+                rows = rows[(self.halt_cycles[rows] < 0) & (self.cycles[rows] < limit[rows])]
+
+    def get_outputs(self):
+        'Return the list of values written to the output register by each instance'
+        outputs = [[] for row in range(self.count)]
+        for rows, values in self.output_log:
+            for row, value in zip(rows.tolist(), values.tolist()):
+                outputs[row].append(value)
+        return outputs
+
+def read_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Run a program on many CPUs with random initial registers')
+    parser.add_argument('infile', type=str, help='Text file with assembler program')
+    parser.add_argument('-b', '--base', type=str, help='Specify starting address for assembler', default='0x0000', dest='offset')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='Number of CPU instances')
+    parser.add_argument('-c', '--max-cycles', type=int, default=1000000, help='Micro instructions run before stopping, 0 for no limit')
+    parser.add_argument('-e', '--seed', type=int, default=0, help='Seed for the initial registers')
+    parser.add_argument('-p', '--print-outputs', action='store_true', help='Print the outputs of every instance')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    print('Lockstep microprocessor simulator. Version 0.1')
+
+    args = read_args()
+    microcode = sim.load_microcode(sim.SRC_MICROCODE)
+    program = asm.Assembler().translate_file(args.infile, args.offset)
+    cpu = LockstepCpu(microcode, args.count)
+    cpu.load_rom(program)
+
+    # Sweep the initial registers
+    generator = np.random.default_rng(args.seed)
+    for reg in (cpu.reg_a, cpu.reg_b, cpu.reg_c, cpu.reg_d):
+        reg[:] = generator.integers(0, 256, args.count)
+
+    start = time.perf_counter()
+    cpu.exec_prog(args.max_cycles or None)
+    elapsed = time.perf_counter() - start
+
+    if args.print_outputs:
+        for row, outputs in enumerate(cpu.get_outputs()):
+            print(row, 'Halt cycle=', cpu.halt_cycles[row], 'Outputs=', outputs)
+    halted = cpu.halt_cycles >= 0
+    print('Instances=', args.count, 'Halted=', int(halted.sum()), 'Undefined opcodes=', int(cpu.undefined.sum()))
+    if halted.any():
+        print('Halt cycles min=', int(cpu.halt_cycles[halted].min()), 'max=', int(cpu.halt_cycles[halted].max()))
+    total = int(cpu.cycles.sum())
+    print('Ran', total, 'cycles in', round(elapsed, 3), 's,', int(total / elapsed), 'cycles/s')
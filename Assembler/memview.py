@@ -0,0 +1,94 @@
+'''
+Memory viewer
+Shows rows of RAM or ROM in the assembler hex layout, marking the bytes changed since the last view
+'''
+
+import assembler as asm
+
+# Bytes in a row of asm.format_code
+ROW = 64
+# Bytes in a page, the unit of the list of memory in use and of the writes tracked
+PAGE = 256
+
+class MemoryView():
+    '''Remembers the contents of a memory at the last view to find what changed since
+    Only the pages marked as written since (see mark) are compared'''
+
+    def __init__(self, memory, default=0xff):
+        self.seen = bytearray(memory)
+        self.default = default
+        # Flag per page written since the last view, the writers of memory set them
+        self.dirty = bytearray(len(memory) // PAGE)
+        # Pages of seen holding bytes other than default
+        self.used = set(used_pages(memory, default))
+
+    def mark(self, start=0, end=None):
+        'Note the bytes from start to end - 1 (start only if end is None) as written'
+        end = start + 1 if end is None else end
+        for page in range(start // PAGE, (end - 1) // PAGE + 1):
+            self.dirty[page] = 1
+
+    def dirty_pages(self):
+        return [index * PAGE for index, flag in enumerate(self.dirty) if flag]
+
+    def update(self, memory):
+        'Take memory as seen, later changes are compared to it'
+        self.used = set(self.used_pages(memory))
+        for page in self.dirty_pages():
+            self.seen[page:page + PAGE] = memory[page:page + PAGE]
+        self.dirty[:] = bytes(len(self.dirty))
+
+    def used_pages(self, memory):
+        'Return the start address of every page of memory holding bytes other than default'
+        blank = bytes([self.default]) * PAGE
+        view = memoryview(memory)
+        used = set(self.used)
+        for page in self.dirty_pages():
+            if view[page:page + PAGE] != blank:
+                used.add(page)
+            else:
+                used.discard(page)
+        return sorted(used)
+
+    def changed_rows(self, memory):
+        'Return the start address of every row changed since the last view'
+        seen = self.seen
+        view = memoryview(memory)
+        rows = []
+        for page in self.dirty_pages():
+            if view[page:page + PAGE] != seen[page:page + PAGE]:
+                rows.extend(row for row in range(page, page + PAGE, ROW) if view[row:row + ROW] != seen[row:row + ROW])
+        return rows
+
+    def render_rows(self, memory, rows):
+        'Return the lines showing the given rows, with a line marking the changed bytes under each changed row'
+        lines = []
+        for row in rows:
+            data = memory[row:row + ROW]
+            lines.append(asm.format_code({row: data.hex()}, pad=False))
+            seen = self.seen[row:row + ROW]
+            if data != seen:
+                marks = ''.join('^^' if data[i] != seen[i] else '  ' for i in range(len(data)))
+                lines.append(' ' * 6 + asm.format_code({row: marks}, pad=False)[6:])
+        return '\n'.join(lines)
+
+    def render(self, memory, start, length=ROW):
+        'Return the lines showing the rows covering length bytes from start'
+        end = min(start + max(length, 1), len(memory))
+        return self.render_rows(memory, range(start - start % ROW, end, ROW))
+
+def used_pages(memory, default):
+    'Return the start address of every page holding bytes other than default'
+    blank = bytes([default]) * PAGE
+    view = memoryview(memory)
+    return [page for page in range(0, len(memory), PAGE) if view[page:page + PAGE] != blank]
+
+def format_pages(pages):
+    'Return the pages as hex ranges of consecutive pages'
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] + PAGE == page:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ', '.join(hex(first)[2:].zfill(4) + '-' + hex(last + PAGE - 1)[2:].zfill(4) for first, last in ranges)
@@ -0,0 +1,167 @@
+'''
+Microcode image generator
+Builds the control ROM image from the microcode header like microcodeGenerator.c and writes it
+in data.txt (read by the uploader) and legible.txt. Images are cached on the hash of the header
+'''
+
+import os
+import re
+import sys
+import marshal
+import hashlib
+import argparse
+import assembler as asm
+import simulator as sim
+
+SRC_LEGIBLE = os.path.join(sim.MICROCODE_DIR, 'legible.txt')
+IMAGE_CACHE = os.path.join(sim.MICROCODE_DIR, 'control_rom.cache')
+# Changes when the images built from the same header change
+GENERATOR_VERSION = 1
+
+# Micro instructions of an instruction (4 address bits), instruction codes and flags come above them
+STEPS = 0x10
+FLAG_SHIFT = 12
+# The image holds the code twice, with the top address pin off and on
+COPY_SIZE = 0x4000
+COPIES = 2
+# Flags each version is written for, in order: later versions overwrite the earlier ones.
+# Only the base version leaves what follows its CLR as it was
+VERSIONS = [('base', (0b00, 0b01, 0b10, 0b11)), ('flaggedCarry', (0b01, 0b11)),
+            ('flaggedEqual', (0b10, 0b11)), ('flaggedBoth', (0b11,))]
+
+START_CODE = re.compile(r'byte\s+startCode\[\]\s*=\s*\{([^}]*)\}')
+CODE_LIST = re.compile(r'Code\s+(\w+)\[\]\s*=\s*\{(.*?)\n\s*\};', re.DOTALL)
+CODE_ENTRY = re.compile(r'\{\s*(\w+)\s*,\s*(\w+)\s*,\s*\(byte\[\]\)\s*\{([^}]*)\}\s*\}')
+
+def control_bytes(items, defines):
+    'Return the control bytes of comma separated micro instructions, each the AND of the signals in it'
+    data = bytearray()
+    for item in items.split(','):
+        if not item.strip():
+            continue
+        value = 0xff
+        for signal in item.split('&'):
+            if signal.strip() not in defines:
+                raise ValueError('unknown signal ' + signal.strip())
+            value = value & defines[signal.strip()]
+        data.append(value)
+    return bytes(data)
+
+def parse_header(header, defines):
+    '''Return the start code and the (instruction code, size, control bytes) entries of each version
+    in the text of the microcode header'''
+    text = '\n'.join(line.split('//')[0] for line in header.splitlines())
+    start = START_CODE.search(text)
+    if not start:
+        raise ValueError('no startCode')
+    versions = {}
+    for name, entries in CODE_LIST.findall(text):
+        versions[name] = []
+        for instr, size, code in CODE_ENTRY.findall(entries):
+            code = control_bytes(code, defines)
+            if int(size, 0) != len(code):
+                raise ValueError('%s code %s has size %s but %d micro instructions' % (name, instr, size, len(code)))
+            versions[name].append((int(instr, 0), len(code), code))
+    for name, flags in VERSIONS:
+        if name not in versions:
+            raise ValueError('no ' + name + ' code')
+    return control_bytes(start.group(1), defines), versions
+
+def build_image(start_code, versions, defines):
+    'Return the control ROM image of the parsed microcode header'
+    clr = bytes([defines['CLR']])
+    nop = defines['NOP']
+    left_over = STEPS - len(start_code)
+    # Every instruction starts with the start code, unused ones clear the step counter after it
+    slot = start_code + (clr if left_over > 0 else b'') + bytes([nop]) * max(left_over - 1, 0)
+    image = bytearray(slot * (COPY_SIZE // STEPS))
+    for name, flags in VERSIONS:
+        for instr, size, code in versions[name]:
+            # Code longer than a slot is cut short
+            size = min(size, left_over)
+            data = code[:size]
+            if size != left_over:
+                data = data + clr
+                if name != 'base':
+                    data = data.ljust(left_over, bytes([nop]))
+            for flag in flags:
+                address = flag << FLAG_SHIFT | instr * STEPS | len(start_code)
+                image[address:address + len(data)] = data
+    return bytes(image * COPIES)
+
+def control_rom(file_name=sim.SRC_MICROCODE, cache_file=IMAGE_CACHE, cache=True, debug=False):
+    'Return the control ROM image of the microcode header file_name, None if it cannot be built'
+    try:
+        with open(file_name, 'rb') as input_file:
+            header = input_file.read()
+    except IOError:
+        print('Cannot open file', file_name)
+        return None
+    key = '%d %s' % (GENERATOR_VERSION, hashlib.sha256(header).hexdigest())
+    if cache:
+        try:
+            with open(cache_file, 'rb') as input_file:
+                cache_key, image = marshal.loads(input_file.read())
+            if cache_key == key:
+                if debug:
+                    print('Read control ROM image from cache', cache_file)
+                return image
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    defines = sim.read_defines(file_name, debug)
+    try:
+        start_code, versions = parse_header(header.decode(), defines)
+    except (ValueError, KeyError) as error:
+        print('Cannot read microcode from file', file_name, '(' + str(error) + ')')
+        return None
+    image = build_image(start_code, versions, defines)
+    if debug:
+        print('Built control ROM image of', len(image), 'bytes')
+    if cache:
+        # Replace the cache atomically, simulators may be reading it
+        temp_file = cache_file + '.' + str(os.getpid())
+        try:
+            with open(temp_file, 'wb') as out_file:
+                out_file.write(marshal.dumps((key, image)))
+            os.replace(temp_file, cache_file)
+        except OSError:
+            print('Cannot write control ROM cache', cache_file)
+    return image
+
+def format_legible(image):
+    'Return the image as lines of 16 bytes in groups of 4, like legible.txt'
+    lines = []
+    for address in range(0, len(image), STEPS):
+        groups = [image[address + i:address + i + 4].hex(' ') for i in range(0, STEPS, 4)]
+        lines.append('%04x: %s  %s   %s  %s' % (address, *groups))
+    return '\n'.join(lines) + '\n'
+
+def write_image(image, data_file=sim.SRC_CONTROL_ROM, legible_file=SRC_LEGIBLE):
+    'Write the image in data_file in the layout read by the uploader and in legible_file if given'
+    try:
+        with open(data_file, 'w') as out_file:
+            out_file.write(asm.format_code({0: image.hex()}, pad=False) + '\n')
+        if legible_file:
+            with open(legible_file, 'w') as out_file:
+                out_file.write(format_legible(image))
+    except IOError as error:
+        print('Cannot write file', error.filename)
+        return False
+    return True
+
+def read_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Build the control ROM image from the microcode header')
+    parser.add_argument('-m', '--microcode', type=str, default=sim.SRC_MICROCODE, help='Microcode header')
+    parser.add_argument('-o', '--outfile', type=str, default=sim.SRC_CONTROL_ROM, help='Image file for the uploader')
+    parser.add_argument('-l', '--legible', type=str, default=SRC_LEGIBLE, help='Image file laid out to be read by people, empty for none')
+    parser.add_argument('-n', '--no-cache', action='store_true', help='Build the image even if the header was built before')
+    parser.add_argument('-d', '--debug', action='store_true', help='Print debug information')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = read_args()
+    image = control_rom(args.microcode, cache=not args.no_cache, debug=args.debug)
+    if image is None or not write_image(image, args.outfile, args.legible):
+        sys.exit(1)
+    print('Wrote', len(image), 'bytes of control ROM in file', args.outfile)
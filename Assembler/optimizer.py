@@ -0,0 +1,378 @@
+'''
+Peephole optimizer
+Rewrites instruction sequences of a program into ones taking fewer cycles, before translation.
+Costs come from the microcode header, each rewrite is reported with the cycles it saves
+'''
+
+import io
+import os
+import sys
+import argparse
+import contextlib
+import assembler as asm
+import simulator as sim
+
+# Register moves by (source, destination)
+MOVES = {(name[1], name[2]): name for name in asm.INST_SET if len(name) == 3 and name[0] == 'M'}
+# Instructions always moving the program counter somewhere else, code after them only runs if jumped to
+STOPS = ('JMP', 'HALT')
+# Passes over the program at most, a pass applies every rewrite it finds
+MAX_PASSES = 20
+# Registers written by the signals of micro instructions
+REGISTER_SIGNALS = {'AI': 'A', 'BI': 'B', 'CI': 'C', 'DI': 'D'}
+# Instructions setting A from its known value in one step: (change of the value, instruction)
+A_STEPS = ((1, 'INC'), (-1, 'DEC'))
+# Cycles the programs are checked for at most (see check_programs)
+CHECK_CYCLES = 2000000
+# Programs checked besides the bundled ones, as (name, lines)
+CHECK_CASES = [('literal jump', ['LDA 05h', 'JMP 0006h', 'HALT', 'OUTA', 'HALT'])]
+
+class Optimizer():
+    'Peephole optimizer of assembler source lines'
+
+    def __init__(self, microcode=None):
+        if microcode is None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                microcode = sim.load_microcode(sim.SRC_MICROCODE)
+        # Cycles of each instruction (with the CLR step ending it), without and with its jump taken
+        self.cycles = {}
+        self.taken_cycles = {}
+        # Whether each instruction reads D before writing it ('read'), always writes it first ('write') or neither
+        self.d_use = {}
+        # Registers each instruction may write
+        self.writes = {}
+        for name, info in asm.INST_SET.items():
+            versions = [microcode[version][info['code']] for version in sim.MICRO_VERSIONS]
+            self.cycles[name] = len(versions[0]) + sim.clear_cycles(versions[0])
+            self.taken_cycles[name] = max(len(seq) + sim.clear_cycles(seq) for seq in versions)
+            uses = [self.first_d_use(seq) for seq in versions]
+            self.d_use[name] = 'read' if 'read' in uses else 'write' if all(use == 'write' for use in uses) else None
+            self.writes[name] = {REGISTER_SIGNALS[signal.strip()] for seq in versions for step in seq
+                                 for signal in step.split('&') if signal.strip() in REGISTER_SIGNALS}
+        self.rewrites = []
+        # Line of the first jump to an address instead of a label, the program is then left as it is
+        self.literal_jump = None
+
+    @staticmethod
+    def first_d_use(seq):
+        for step in seq:
+            signals = [signal.strip() for signal in step.split('&')]
+            if 'DO' in signals:
+                return 'read'
+            if 'DI' in signals:
+                return 'write'
+        return None
+
+    def parse(self, lines):
+        'Return a statement per line: its text and, for code lines, label, instruction and parameters with aliases replaced'
+        aliases = {}
+        statements = []
+        for line_no, line in enumerate(lines, 1):
+            statement = {'line_no': line_no, 'text': line, 'special': line.startswith(asm.SPEC_CMD_CHAR),
+                         'label': None, 'instr': None, 'params': []}
+            if statement['special']:
+                info = asm.parse_line(line[1:])
+                if info['instr'] == asm.ALIAS_DEF and len(info['params']) >= 2:
+                    aliases[info['params'][0]] = ' '.join(info['params'][1:])
+            else:
+                statement.update(asm.parse_line(line, aliases))
+                instr = statement['instr']
+                if instr and (instr not in asm.INST_SET or len(statement['params']) != len(asm.INST_SET[instr]['params'])):
+                    # Left as it is for the assembler to report
+                    statement['special'] = True
+                elif instr and self.literal_jump is None and any(
+                        param == 'addr_l' and asm.LITERAL_ADDRESS.match(value)
+                        for param, value in zip(asm.INST_SET[instr]['params'], statement['params'])):
+                    self.literal_jump = line_no
+            statements.append(statement)
+        return statements
+
+    def report(self, statement, text, cycles):
+        self.rewrites.append((statement['line_no'], text, cycles))
+
+    def set_instr(self, statement, instr, params):
+        'Change the instruction of a statement, keeping its label'
+        statement['instr'] = instr
+        statement['params'] = params
+        code = ' '.join([instr] + params) if instr else ''
+        statement['text'] = (statement['label'] + asm.LABEL_SEP if statement['label'] else '') + ' ' + code
+
+    def remove(self, statement):
+        self.set_instr(statement, None, [])
+
+    def code_before(self, statements, index):
+        'Return the index of the instruction running before the one at index, None if it can be reached another way'
+        for prev_index in range(index - 1, -1, -1):
+            if statements[prev_index]['special']:
+                return None
+            if statements[prev_index]['instr']:
+                return None if self.labels_between(statements, prev_index + 1, index) else prev_index
+        return None
+
+    def code_after(self, statements, index):
+        'Return the index of the instruction running after the one at index, None if a special command comes first'
+        for next_index in range(index + 1, len(statements)):
+            if statements[next_index]['special']:
+                return None
+            if statements[next_index]['instr']:
+                return next_index
+        return None
+
+    def labels_between(self, statements, first, last):
+        'Return the labels defined from statement first to statement last included'
+        return [statement['label'] for statement in statements[first:last + 1] if statement['label']]
+
+    def label_lines(self, statements):
+        'Return the index of the statement defining each label'
+        return {statement['label']: index for index, statement in enumerate(statements) if statement['label'] and not statement['special']}
+
+    def target(self, statements, labels, label):
+        'Return the index of the instruction a label points to, None if unknown or a special command comes first'
+        index = labels.get(label)
+        if index is None or statements[index]['instr']:
+            return index
+        return self.code_after(statements, index)
+
+    def d_is_dead(self, statements, index):
+        'True when D is written before being read by the straight line code from the instruction at index'
+        while index is not None:
+            statement = statements[index]
+            use = self.d_use[statement['instr']]
+            if use:
+                return use == 'write'
+            if statement['instr'] in STOPS or statement['instr'].startswith('J') or statement['instr'].startswith('R'):
+                return False
+            next_index = self.code_after(statements, index)
+            if next_index is not None and self.labels_between(statements, index + 1, next_index):
+                return False
+            index = next_index
+        return False
+
+    def same_value(self, first, second):
+        'True when two parameters give the same value'
+        first, second = asm.validate_hex(first, 4), asm.validate_hex(second, 4)
+        return not first.startswith('Error') and first == second
+
+    @staticmethod
+    def value(param):
+        'Return the byte a parameter gives, None if it is not one'
+        value = asm.validate_hex(param, 2)
+        try:
+            return int(value, 16)
+        except ValueError:
+            return None
+
+    def last_writer(self, statements, index, registers):
+        'Return the index of the last instruction writing one of registers before the one at index, None if not known'
+        index = self.code_before(statements, index)
+        while index is not None and not self.writes[statements[index]['instr']] & registers:
+            index = self.code_before(statements, index)
+        return index
+
+    def rewrite_load_a(self, statements, index):
+        '''Replace a load of A by an instruction computing the value from what A holds, return True if it was
+        LDA 00h when A equals B (after MAB or MBA) becomes SUB, LDA v when A holds v - 1 or v + 1 becomes INC or DEC'''
+        statement = statements[index]
+        value = self.value(statement['params'][0])
+        if value is None:
+            return False
+        replacement = None
+        setter = self.last_writer(statements, index, {'A', 'B'})
+        if value == 0 and setter is not None and statements[setter]['instr'] in ('MAB', 'MBA'):
+            replacement = 'SUB'
+        setter = self.last_writer(statements, index, {'A'}) if replacement is None else setter
+        if replacement is None and setter is not None and statements[setter]['instr'] == 'LDA':
+            known = self.value(statements[setter]['params'][0])
+            for change, instr in A_STEPS:
+                if known is not None and (known + change) & 0xff == value:
+                    replacement = instr
+        if replacement is None or self.cycles[replacement] >= self.cycles['LDA']:
+            return False
+        previous = statements[setter]
+        self.report(statement, 'replaced LDA ' + statement['params'][0] + ' by ' + replacement + ' after ' +
+                    ' '.join([previous['instr']] + previous['params']), self.cycles['LDA'] - self.cycles[replacement])
+        self.set_instr(statement, replacement, [])
+        return True
+
+    def rewrite_pair(self, statements, index, next_index):
+        'Apply the rewrites of an instruction and the one running after it, return True if one was applied'
+        first, second = statements[index], statements[next_index]
+        name, next_name = first['instr'], second['instr']
+        # Nothing jumps to the second instruction, it always runs after the first one
+        straight = not self.labels_between(statements, index + 1, next_index)
+        # Move back or again: Mxy then Myx or Mxy
+        if straight and name in MOVES.values() and next_name in (name, 'M' + name[2] + name[1]):
+            self.report(second, 'removed ' + next_name + ' after ' + name + ', registers already equal', self.cycles[next_name])
+            self.remove(second)
+            return True
+        # Load of a value just loaded in another register: LDx v then LDy v
+        if (straight and name[:2] == 'LD' and next_name[:2] == 'LD' and (name[2], next_name[2]) in MOVES
+                and self.same_value(first['params'][0], second['params'][0])):
+            move = MOVES[(name[2], next_name[2])]
+            if self.cycles[move] < self.cycles[next_name]:
+                self.report(second, 'replaced ' + next_name + ' ' + second['params'][0] + ' by ' + move, self.cycles[next_name] - self.cycles[move])
+                self.set_instr(second, move, [])
+                return True
+        # Register overwritten before being used: LDx or Myx then an instruction setting x without reading it.
+        # LRx is never removed, it also sets the RAM address later instructions may use
+        written = self.writes_only(name)
+        if written and self.writes_only(next_name, ram_address=True) == written:
+            self.report(first, 'removed ' + ' '.join([name] + first['params']) + ', ' + written + ' is set again by ' + next_name, self.cycles[name])
+            self.remove(first)
+            return True
+        return False
+
+    @staticmethod
+    def writes_only(name, ram_address=False):
+        '''Return the register an instruction sets without reading it or doing anything else, None if there is none
+        With ram_address, loads from RAM (LRx, also setting the RAM address) count too'''
+        if (name[:2] == 'LD' or ram_address and name[:2] == 'LR') and len(name) == 3 and name[2] in 'ABCD':
+            return name[2]
+        if name in MOVES.values():
+            return name[2]
+        return None
+
+    def rewrite_jump(self, statements, index, labels):
+        'Thread a jump to a jump and remove a jump to the next instruction, return True if one was applied'
+        statement = statements[index]
+        label = statement['params'][0] if statement['params'] else None
+        if label not in labels:
+            return False
+        # Follow the chain of unconditional jumps, leaving loops as they are
+        final = label
+        seen = {label}
+        while True:
+            target = self.target(statements, labels, final)
+            if target is None or statements[target]['instr'] != 'JMP':
+                break
+            next_label = statements[target]['params'][0]
+            if next_label in seen:
+                final = label
+                break
+            seen.add(next_label)
+            final = next_label
+        if final != label:
+            self.report(statement, 'jump to ' + label + ' goes straight to ' + final, self.taken_cycles['JMP'])
+            self.set_instr(statement, statement['instr'], [final])
+            return True
+        next_index = self.code_after(statements, index)
+        if (next_index is not None and label in self.labels_between(statements, index + 1, next_index)
+                and self.d_is_dead(statements, next_index)):
+            self.report(statement, 'removed ' + statement['instr'] + ' to the next instruction', self.taken_cycles[statement['instr']])
+            self.remove(statement)
+            return True
+        return False
+
+    def remove_dead_code(self, statements):
+        '''Remove the instructions after JMP or HALT up to the next label, return True if there were some
+        Only labelled code is taken as a jump target, optimize doesn't run on programs jumping to addresses'''
+        removed = False
+        dead = False
+        for statement in statements:
+            if statement['special'] or statement['label']:
+                dead = False
+            if dead and statement['instr']:
+                self.report(statement, 'removed unreachable ' + statement['instr'], 0)
+                self.remove(statement)
+                removed = True
+            elif statement['instr'] in STOPS:
+                dead = True
+        return removed
+
+    def optimize(self, lines):
+        'Return the lines of a program with the rewrites applied, the same number of them (see rewrites)'
+        self.rewrites = []
+        self.literal_jump = None
+        statements = self.parse(lines)
+        if self.literal_jump is not None:
+            # Code without a label can be jumped to, and every rewrite moves the code after it
+            return list(lines)
+        labels = self.label_lines(statements)
+        for count in range(MAX_PASSES):
+            changed = self.remove_dead_code(statements)
+            for index, statement in enumerate(statements):
+                if statement['special'] or not statement['instr']:
+                    continue
+                if statement['instr'].startswith('J') and self.rewrite_jump(statements, index, labels):
+                    changed = True
+                    continue
+                if statement['instr'] == 'LDA' and self.rewrite_load_a(statements, index):
+                    changed = True
+                    continue
+                next_index = self.code_after(statements, index)
+                if next_index is not None and self.rewrite_pair(statements, index, next_index):
+                    changed = True
+            if not changed:
+                break
+        self.rewrites.sort()
+        return [statement['text'] for statement in statements]
+
+    def print_report(self):
+        if self.literal_jump is not None:
+            print('Line', self.literal_jump, ': jump to an address instead of a label, program left as it is')
+        for line_no, text, cycles in self.rewrites:
+            print('Line', line_no, ':', text, '(' + (str(cycles) + ' cycles saved' if cycles else 'smaller code') + ')')
+        print('Optimizer made', len(self.rewrites), 'rewrites saving', sum(cycles for line_no, text, cycles in self.rewrites),
+              'cycles per pass through them')
+
+def same_outputs(result, optimized):
+    '''True when a program run as it is and optimized gave the same outputs and registers
+    Runs stopped before halting only need the outputs of the shorter one to start those of the longer one'''
+    if 'error' in result or 'error' in optimized:
+        # Errors name the address they were found at, moved by the rewrites
+        return 'error' in result and 'error' in optimized and result['error'].splitlines()[-1:] == optimized['error'].splitlines()[-1:]
+    if result['halted'] != optimized['halted']:
+        return False
+    if not result['halted']:
+        count = min(len(result['outputs']), len(optimized['outputs']))
+        return result['outputs'][:count] == optimized['outputs'][:count]
+    # The PC and D are left where the rewritten jumps put them
+    registers = [{name: value for name, value in run['registers'].items() if name not in ('pc', 'd')} for run in (result, optimized)]
+    return result['outputs'] == optimized['outputs'] and registers[0] == registers[1]
+
+def check_programs(sources, max_cycles=CHECK_CYCLES, control_rom=False):
+    '''Run each program of sources, file names or (name, lines) pairs, as it is and optimized for max_cycles at most
+    Yield the name, the rewrites, the results of both runs (see simulator.run_program) and whether they agree'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        cpu = sim.make_cpu(control_rom)
+    peephole = Optimizer()
+    for source in sources:
+        file_name = source if isinstance(source, str) else source[0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            lines = asm.read_file(source) if isinstance(source, str) else source[1]
+        if not lines:
+            result = {'error': 'Cannot read program'}
+            yield file_name, [], result, result, True
+            continue
+        optimized_lines = peephole.optimize(lines)
+        result = sim.run_program(cpu, (file_name, lines), max_cycles=max_cycles)
+        optimized = sim.run_program(cpu, (file_name, optimized_lines), max_cycles=max_cycles)
+        yield file_name, peephole.rewrites, result, optimized, same_outputs(result, optimized)
+
+def read_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Check that programs give the same outputs with and without the optimizer')
+    parser.add_argument('infiles', type=str, nargs='*', help='Programs to check, the bundled ones and CHECK_CASES if none')
+    parser.add_argument('-c', '--max-cycles', type=int, default=CHECK_CYCLES, help='Cycles each program runs for at most')
+    parser.add_argument('-r', '--control-rom', action='store_true', help='Execute the control ROM image instead of the microcode header')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = read_args()
+    if args.infiles:
+        file_names = args.infiles
+    else:
+        # Only needed to list the bundled programs
+        import benchmark
+        file_names = benchmark.list_programs() + CHECK_CASES
+    failed = 0
+    for file_name, rewrites, result, optimized, same in check_programs(file_names, args.max_cycles, args.control_rom):
+        if 'error' in result:
+            status = result['error'].splitlines()[-1] if result['error'] else 'error'
+        else:
+            status = '%d -> %d cycles%s' % (result['cycles'], optimized['cycles'], '' if result['halted'] else ' (stopped)')
+        print('%-28s %-4s %2d rewrites, %s' % (os.path.basename(file_name), 'OK' if same else 'DIFF', len(rewrites), status))
+        failed = failed + (not same)
+    if failed:
+        print(failed, 'programs differ when optimized')
+        sys.exit(1)
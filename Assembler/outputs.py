@@ -0,0 +1,108 @@
+'''
+Output devices for the CPU output register
+Every value clocked into the output register is written to the sink attached to the CPU
+'''
+
+import sys
+import time
+import collections
+
+class PrintSink():
+    'Print every output value as it is written'
+
+    def write(self, value):
+        print('Output=', hex(value)[2:].zfill(2), '(', value, ')')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class BufferedPrintSink():
+    'Print output values in batches, when size lines are waiting or interval seconds went by'
+
+    def __init__(self, stream=None, size=4096, interval=0.1):
+        self.stream = stream or sys.stdout
+        self.size = size
+        self.interval = interval
+        self.lines = []
+        self.last_flush = time.monotonic()
+
+    def write(self, value):
+        self.lines.append('Output= %02x ( %d )\n' % (value, value))
+        if len(self.lines) >= self.size or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.stream.write(''.join(self.lines))
+            self.stream.flush()
+            self.lines = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+class RingSink():
+    'Keep the last size output values in memory, all of them if size is None'
+
+    def __init__(self, size=None):
+        self.values = collections.deque(maxlen=size)
+        # Bound method, saves a lookup per value
+        self.write = self.values.append
+
+    def get_values(self):
+        return list(self.values)
+
+    def clear(self):
+        self.values.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class FileSink():
+    'Write output values to a file, a decimal value per line or a byte per value if binary'
+
+    # Bytes kept before writing a binary file
+    CHUNK = 65536
+
+    def __init__(self, file_name, binary=False):
+        self.binary = binary
+        self.out_file = open(file_name, 'wb' if binary else 'w')
+        self.data = bytearray()
+
+    def write(self, value):
+        if self.binary:
+            self.data.append(value)
+            if len(self.data) >= self.CHUNK:
+                self.flush()
+        else:
+            self.out_file.write('%d\n' % value)
+
+    def flush(self):
+        if self.data:
+            self.out_file.write(self.data)
+            self.data = bytearray()
+        self.out_file.flush()
+
+    def close(self):
+        self.flush()
+        self.out_file.close()
+
+class CallbackSink():
+    'Call function with every output value'
+
+    def __init__(self, function, flush=None):
+        self.write = function
+        self.flush_function = flush
+
+    def flush(self):
+        if self.flush_function:
+            self.flush_function()
+
+    def close(self):
+        self.flush()
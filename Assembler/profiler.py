@@ -0,0 +1,139 @@
+'''
+Guest program profiler
+Counts where the cycles of a program running in the simulator go
+'''
+
+import json
+import assembler as asm
+
+class Profiler():
+    'Counters of executed instructions, ROM addresses, RAM accesses and conditional jumps'
+
+    MEM_SIZE = 0x10000
+
+    def __init__(self, rom):
+        self.rom = rom
+        self.names = {}
+        self.lengths = {}
+        self.branches = set()
+        for code, (name, params, size) in asm.OPCODES.items():
+            self.names[code] = name
+            self.lengths[code] = size
+            if name.startswith('J') and name != 'JMP':
+                self.branches.add(code)
+        self.labels = []
+        self.reset()
+
+    def reset(self):
+        self.instr_counts = [0] * 256
+        self.instr_cycles = [0] * 256
+        self.addr_counts = [0] * self.MEM_SIZE
+        self.addr_cycles = [0] * self.MEM_SIZE
+        self.ram_reads = [0] * self.MEM_SIZE
+        self.ram_writes = [0] * self.MEM_SIZE
+        # Taken and not taken counts of each conditional jump address
+        self.jumps = {}
+
+    def set_labels(self, labels):
+        'Name code regions after the labels, a dict of name and address'
+        self.labels = sorted((address, name) for name, address in labels.items())
+
+    def record(self, pc, instr, cycles, next_pc):
+        'Count an instruction run at pc that left the program counter at next_pc'
+        self.instr_counts[instr] += 1
+        self.instr_cycles[instr] += cycles
+        self.addr_counts[pc] += 1
+        self.addr_cycles[pc] += cycles
+        if instr in self.branches:
+            counts = self.jumps.setdefault(pc, [0, 0])
+            if next_pc != (pc + self.lengths[instr]) & 0xffff:
+                counts[0] += 1
+            else:
+                counts[1] += 1
+
+    def instr_name(self, instr):
+        return self.names.get(instr, hex(instr)[2:].zfill(2))
+
+    def region(self, address):
+        'Return the name of the last label at or before address'
+        name = 'start'
+        for label_address, label in self.labels:
+            if label_address > address:
+                break
+            name = label
+        return name
+
+    def used(self, counts):
+        return [address for address, count in enumerate(counts) if count]
+
+    def to_dict(self):
+        return {'instructions': {self.instr_name(instr): {'count': self.instr_counts[instr], 'cycles': self.instr_cycles[instr]}
+                                 for instr in self.used(self.instr_counts)},
+                'addresses': {hex(address)[2:].zfill(4): {'instr': self.instr_name(self.rom[address]),
+                                                          'count': self.addr_counts[address],
+                                                          'cycles': self.addr_cycles[address]}
+                              for address in self.used(self.addr_counts)},
+                'ram': {hex(address)[2:].zfill(4): {'reads': self.ram_reads[address], 'writes': self.ram_writes[address]}
+                        for address in sorted(set(self.used(self.ram_reads) + self.used(self.ram_writes)))},
+                'jumps': {hex(address)[2:].zfill(4): {'instr': self.instr_name(self.rom[address]),
+                                                      'taken': taken, 'not_taken': not_taken}
+                          for address, (taken, not_taken) in sorted(self.jumps.items())}}
+
+    def collapsed_stacks(self, program='program'):
+        'Return the cycles of every address as program;label;instruction stacks for flame graphs'
+        lines = []
+        for address in self.used(self.addr_cycles):
+            frames = [program, self.region(address), hex(address)[2:].zfill(4) + ' ' + self.instr_name(self.rom[address])]
+            lines.append(';'.join(frame.replace(';', '_').replace(' ', '_') for frame in frames) + ' ' + str(self.addr_cycles[address]))
+        return lines
+
+    def write_json(self, file_name):
+        try:
+            with open(file_name, 'w') as out_file:
+                json.dump(self.to_dict(), out_file, indent=2)
+            print('Wrote profile in file', file_name)
+            return True
+        except IOError:
+            print('Cannot open file', file_name)
+            return False
+
+    def write_stacks(self, file_name, program='program'):
+        try:
+            with open(file_name, 'w') as out_file:
+                for line in self.collapsed_stacks(program):
+                    out_file.write(line + '\n')
+            print('Wrote collapsed stacks in file', file_name)
+            return True
+        except IOError:
+            print('Cannot open file', file_name)
+            return False
+
+    def print_report(self, top=10):
+        total = sum(self.instr_cycles)
+        if not total:
+            print('No instructions profiled')
+            return
+        print('================================')
+        print('Instructions', sum(self.instr_counts), 'Cycles', total)
+        print('--------------------------------')
+        print('Instr     Count     Cycles  Cycles%')
+        for instr in sorted(self.used(self.instr_counts), key=lambda instr: -self.instr_cycles[instr]):
+            print(self.instr_name(instr).ljust(6), str(self.instr_counts[instr]).rjust(8), str(self.instr_cycles[instr]).rjust(10),
+                  str(round(self.instr_cycles[instr] * 100 / total, 1)).rjust(7))
+        print('--------------------------------')
+        print('Addr Instr     Count     Cycles  Cycles%  Label')
+        for address in sorted(self.used(self.addr_counts), key=lambda address: -self.addr_cycles[address])[:top]:
+            print(hex(address)[2:].zfill(4), self.instr_name(self.rom[address]).ljust(6), str(self.addr_counts[address]).rjust(8),
+                  str(self.addr_cycles[address]).rjust(10), str(round(self.addr_cycles[address] * 100 / total, 1)).rjust(7), '', self.region(address))
+        accessed = set(self.used(self.ram_reads) + self.used(self.ram_writes))
+        if accessed:
+            print('--------------------------------')
+            print('RAM     Reads   Writes')
+            for address in sorted(accessed, key=lambda address: -(self.ram_reads[address] + self.ram_writes[address]))[:top]:
+                print(hex(address)[2:].zfill(4), str(self.ram_reads[address]).rjust(8), str(self.ram_writes[address]).rjust(8))
+        if self.jumps:
+            print('--------------------------------')
+            print('Addr Instr     Taken  Not taken')
+            for address, (taken, not_taken) in sorted(self.jumps.items(), key=lambda item: -sum(item[1])):
+                print(hex(address)[2:].zfill(4), self.instr_name(self.rom[address]).ljust(6), str(taken).rjust(8), str(not_taken).rjust(10))
+        print('================================')
@@ -2,15 +2,42 @@
 CPU Emulator
 '''
 
+import io
 import os
+import re
 import sys
+import copy
+import json
+import zlib
+import struct
+import hashlib
+import marshal
 import argparse
+import functools
+import contextlib
 from collections import namedtuple
 import assembler as asm
+import profiler as prof
+import journal as jour
+import tracer as tr
+import outputs as out
+import memview as mv
 import cmd
 import time
 
-SRC_MICROCODE = r'..\Microcode\microcode.h'
+MICROCODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Microcode')
+SRC_MICROCODE = os.path.join(MICROCODE_DIR, 'microcode.h')
+SRC_CONTROL_ROM = os.path.join(MICROCODE_DIR, 'data.txt')
+MICROCODE_CACHE = os.path.join(MICROCODE_DIR, 'microcode.cache')
+# Bump when read_microcode changes what it returns for the same header
+MICROCODE_PARSER_VERSION = 1
+# Snapshots are this header (registers, flags, micro instruction state, counters) followed by RAM and ROM
+SNAPSHOT_MAGIC = b'CPUS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sB10B3?3BHQQ')
+# Micro instructions of an instruction in the control ROM. Shorter sequences end with a CLR step
+# taking a clock of its own, counted in the cycles as on the hardware
+CONTROL_STEPS = 16
 
 class CmdLine(cmd.Cmd):
     intro = 'Type help or ? to list commands.\n'
@@ -34,6 +61,7 @@ class CmdLine(cmd.Cmd):
         # return line
 
     def postcmd(self, stop, line):
+        cpu.output.flush()
         print()
 
     # ----- commands -----
@@ -60,6 +88,28 @@ class CmdLine(cmd.Cmd):
         'Print CPU Status'
         cpu.print_cpu()
 
+    def do_mem(self, arg):
+        'Show RAM from an address for a length (hex, 40 by default), e.g. mem 10 20 or mem rom 0 100, the pages in use if no address is given'
+        option = arg.split()
+        name, memory, view = 'RAM', cpu.ram, cpu.ram_view
+        if option and option[0].lower() == 'rom':
+            name, memory, view = 'ROM', cpu.rom, cpu.rom_view
+            option = option[1:]
+        if not option:
+            print(name, 'pages in use=', mv.format_pages(view.used_pages(memory)) or 'none')
+            return
+        try:
+            start = int(option[0], 16) % cpu.MEM_SIZE
+            length = int(option[1], 16) if len(option) > 1 else mv.ROW
+        except ValueError:
+            print('Invalid hex value')
+            return
+        print(view.render(memory, start, length))
+
+    def do_diff(self, arg):
+        'Show the RAM and ROM rows changed since they were last shown'
+        cpu.print_diff()
+
     def do_debug(self, arg):
         'Set CPU instruction debug flag (true, false)'
         option = arg.lower()
@@ -82,6 +132,7 @@ class CmdLine(cmd.Cmd):
 
     def do_exit(self, arg):
         'Exit simulator'
+        cpu.set_tracer(None)
         sys.exit()
 
     def do_load(self, arg):
@@ -90,9 +141,10 @@ class CmdLine(cmd.Cmd):
         offset = input('Memory offset? [0000] ')
         if not offset:
             offset = '0000'
-        program = asm.translate_file(infile, offset, True, False)
-        #print(asm.INST_SET)
-        #print(program)
+        program = load_assembler(True).assemble_file(infile, offset)
+        if not program:
+            print('Errors found, program not loaded')
+            return
         cpu.load_rom(program)
 
     def do_run(self, arg):
@@ -119,6 +171,60 @@ class CmdLine(cmd.Cmd):
         print('After CPU state')
         cpu.print_mcode_status()
 
+    def do_rstep(self, arg):
+        'Run backwards to the start of the instruction, or of the previous one (needs journal on)'
+        if self.rewind(cpu.rewind_instr):
+            cpu.print_cpu()
+
+    def do_rmstep(self, arg):
+        'Run one micro instruction backwards (needs journal on)'
+        if self.rewind(cpu.rewind_microinstr):
+            cpu.print_mcode_status()
+
+    def do_rcont(self, arg):
+        'Run backwards until a breakpoint (needs journal on)'
+        if not cpu.journal:
+            print('Journal is off')
+            return
+        if cpu.rewind_to_break():
+            print('Found breakpoint at address')
+            cpu.print_pc()
+        else:
+            print('Reached the oldest step recorded')
+        print()
+        print('Before CPU state')
+        cpu.print_cpu()
+
+    def rewind(self, function):
+        if not cpu.journal:
+            print('Journal is off')
+            return False
+        if not function():
+            print('Reached the oldest step recorded')
+            return False
+        print()
+        print('Before CPU state')
+        return True
+
+    def do_journal(self, arg):
+        'Record micro instructions run, to run backwards (on [size], off, clear)'
+        option = arg.split()
+        if not option:
+            option = ['']
+        if option[0].lower() in ('on', 'true') and len(option) <= 2:
+            try:
+                size = int(option[1]) if len(option) == 2 else jour.JOURNAL_SIZE
+            except ValueError:
+                print('Invalid size "' + option[1] + '"')
+                return
+            cpu.set_journal(True, size)
+        elif option[0].lower() in ('off', 'false'):
+            cpu.set_journal(False)
+        elif option[0] == 'clear':
+            cpu.clear_journal()
+        else:
+            print('Invalid option "' + arg + '"')
+
     def do_cont(self, arg):
         'Clear the Halt flag'
         cpu.unhalt()
@@ -126,25 +232,27 @@ class CmdLine(cmd.Cmd):
     def do_setpc(self, arg):
         'Set program counter to value (hex)'
         try:
-            value = int(arg, 16)
-            pc = arg.lower().zfill(4)
-            cpu.set_pc(pc[:2], 'HIGH')
-            cpu.set_pc(pc[2:], 'LOW')
+            value = int(arg, 16) & 0xffff
+            cpu.set_pc(value >> 8, 'HIGH')
+            cpu.set_pc(value & 0xff, 'LOW')
+            cpu.clear_journal()
         except ValueError:
             print('Invalid hex value')
 
     def do_setb(self, arg):
-        'Set a breakpoint at a ROM address'
+        'Set a breakpoint at a ROM address (hex), optionally only stopping when a condition is true (e.g. setb 1c a == 3 and ram[0x10] > 2)'
         if not arg:
-            addr = input('ROM address (hex)? ')
-        else:
-            addr = arg
+            arg = input('ROM address (hex)? ')
+        addr, condition = (arg.split(None, 1) + [None])[:2]
         try:
             addr = int(addr, 16)
-            cpu.set_break(addr)
         except ValueError:
             print('Invalid hex value')
             return
+        try:
+            cpu.set_break(addr, condition)
+        except SyntaxError:
+            print('Invalid condition "' + condition + '"')
 
     def do_delb(self, arg):
         'Delete a breakpoint for given ROM address'
@@ -152,58 +260,314 @@ class CmdLine(cmd.Cmd):
             addr = input('ROM address (hex)? ')
         else:
             addr = arg
-        cpu.clr_break(addr)
+        try:
+            cpu.clr_break(int(addr, 16))
+        except ValueError:
+            print('Invalid hex value')
 
     def do_delallb(self, arg):
         'Delete all breakpoints'
         cpu.reset_breaks()
 
+    def do_setw(self, arg):
+        'Stop after an instruction accesses RAM at an address or range (hex), e.g. setw 10 or setw 10-1f r (r, w or rw, w by default)'
+        if not arg:
+            arg = input('RAM address or range (hex)? ')
+        option = arg.split()
+        access = option[1].lower() if len(option) > 1 else 'w'
+        if len(option) > 2 or access not in ('r', 'w', 'rw'):
+            print('Invalid option "' + arg + '"')
+            return
+        try:
+            bounds = [int(addr, 16) for addr in option[0].split('-')]
+        except ValueError:
+            print('Invalid hex value')
+            return
+        cpu.set_watch(bounds[0], bounds[-1], 'r' in access, 'w' in access)
+
+    def do_delw(self, arg):
+        'Delete the watchpoints starting at a RAM address (hex)'
+        if not arg:
+            arg = input('RAM address (hex)? ')
+        try:
+            cpu.clr_watch(int(arg, 16))
+        except ValueError:
+            print('Invalid hex value')
+
+    def do_delallw(self, arg):
+        'Delete all watchpoints'
+        cpu.reset_watches()
+
     def do_reset(self, arg):
         'Reset CPU'
         cpu.reset()
 
+    def do_trace(self, arg):
+        'Write a record of every micro instruction run in a file (see tracer.py), off to stop'
+        if not arg:
+            print('Tracing to', cpu.tracer.file_name if cpu.tracer else 'nowhere')
+            return
+        try:
+            cpu.set_tracer(None if arg.lower() in ('off', 'false') else arg)
+        except IOError:
+            print('Cannot open file', arg)
+
+    def do_snapshot(self, arg):
+        'Save the CPU state in a file, or in memory if no file is given'
+        if arg:
+            cpu.save_snapshot(arg)
+        else:
+            self.snapshot = cpu.snapshot()
+            print('Saved CPU state in memory')
+
+    def do_restore(self, arg):
+        'Restore the CPU state saved in a file, or the one saved in memory if no file is given'
+        if arg:
+            if not cpu.load_snapshot(arg):
+                return
+        elif getattr(self, 'snapshot', None):
+            cpu.restore(self.snapshot)
+        else:
+            print('No CPU state saved in memory')
+            return
+        print('Restored CPU state')
+        cpu.print_cpu()
+
+    def do_profile(self, arg):
+        'Profile runs (on, off, clear, report, json <file>, stacks <file>)'
+        option = arg.split()
+        if not option:
+            option = ['']
+        if option[0].lower() in ('on', 'true'):
+            cpu.set_profiler(True)
+            if cpu.profiler:
+                cpu.profiler.set_labels(program_labels())
+        elif option[0].lower() in ('off', 'false'):
+            cpu.set_profiler(False)
+        elif not cpu.profiler:
+            print('Profiling is off')
+        elif option[0] == 'clear':
+            cpu.profiler.reset()
+        elif option[0] == 'report':
+            cpu.profiler.print_report()
+        elif option[0] == 'json' and len(option) == 2:
+            cpu.profiler.write_json(option[1])
+        elif option[0] == 'stacks' and len(option) == 2:
+            cpu.profiler.write_stacks(option[1])
+        else:
+            print('Invalid option "' + arg + '"')
+
+class Breakpoint():
+    'ROM address breakpoint, stopping only when its condition (a Python expression over the CPU state) is true'
+
+    def __init__(self, address, condition=None):
+        self.address = address
+        self.condition = condition
+        self.code = compile(condition, '<breakpoint>', 'eval') if condition else None
+        # Times the address was reached and times it stopped the CPU
+        self.count = 0
+        self.hits = 0
+
+    def matches(self, cpu):
+        if not self.code:
+            return True
+        names = {'a': cpu.reg_a, 'b': cpu.reg_b, 'c': cpu.reg_c, 'd': cpu.reg_d, 'o': cpu.reg_o,
+                 'pc': cpu.pc_ptr, 'rp': cpu.ram_ptr, 'carry': cpu.carry_flag, 'equal': cpu.equal_flag,
+                 'ram': cpu.ram, 'rom': cpu.rom, 'cycles': cpu.cycles, 'instructions': cpu.instructions,
+                 'count': self.count}
+        try:
+            return bool(eval(self.code, {}, names))
+        except Exception as error:
+            print('Breakpoint condition "' + self.condition + '" failed:', repr(error))
+            return True
+
+    def reached(self, cpu):
+        'Count a visit to the address, return True if the CPU has to stop'
+        self.count = self.count + 1
+        if not self.matches(cpu):
+            return False
+        self.hits = self.hits + 1
+        return True
+
+    def __str__(self):
+        text = str(self.address) + '(' + hex(self.address)[2:].zfill(4) + 'h)'
+        if self.condition:
+            text = text + ' if ' + self.condition
+        return text + ' hits ' + str(self.hits)
+
+class Watchpoint():
+    'RAM watchpoint on addresses start to end, stopping the CPU after an instruction reading or writing them'
+
+    def __init__(self, start, end, read=False, write=True):
+        self.start = start
+        self.end = end
+        self.read = read
+        self.write = write
+        self.hits = 0
+
+    def __str__(self):
+        text = hex(self.start)[2:].zfill(4) + 'h'
+        if self.end != self.start:
+            text = text + '-' + hex(self.end)[2:].zfill(4) + 'h'
+        return text + ' ' + ('r' if self.read else '') + ('w' if self.write else '') + ' hits ' + str(self.hits)
+
 class Cpu():
     'CPU Simulator'
 
-    DEFAULT_ROM = 'ff'
-    DEFAULT_RAM = 'ff'
+    DEFAULT_ROM = 0xff
+    DEFAULT_RAM = 0xff
+    # Changed memory rows shown at most by print_cpu, see print_diff
+    CHANGED_ROWS = 8
+    MEM_SIZE = 0x10000
     NO_OP_MAX = 10
+    # Control signal values, read from the microcode header when tracing
+    defines = None
+    # State a micro instruction can change, recorded by the journal
+    JOURNAL_FIELDS = ('reg_a', 'reg_b', 'reg_c', 'reg_d', 'reg_o', 'bus', 'ram_low', 'ram_high', 'ram_ptr',
+                      'pc_low', 'pc_high', 'pc_ptr', 'carry_flag', 'equal_flag', 'halted', 'mic', 'no_op_count',
+                      'cycles', 'instructions', 'cur_instr', 'cur_version', 'instr_pc')
 
     def __init__(self, microcode=None, clock_period=0, debug=False, mc_debug=False):
         self.microcode = microcode
+        self.fused = compile_microcode(microcode) if microcode else None
+        self.blocks = {}
+        self.block_pages = {}
+        # Whether the translated blocks check their RAM accesses against the watchpoints
+        self.block_watch = False
         self.clock_period = clock_period
         self.debug = debug
         self.mc_debug = mc_debug
-        self.rom = {}
-        self.break_pts = set()
+        self.rom = bytearray([self.DEFAULT_ROM]) * self.MEM_SIZE
+        self.ram = bytearray([self.DEFAULT_RAM]) * self.MEM_SIZE
+        # ROM and translated blocks shared with forks, see fork
+        self.rom_shared = False
+        # Breakpoint of each ROM address
+        self.break_pts = {}
+        # Watchpoint of each RAM address read or written
+        self.watch_reads = {}
+        self.watch_writes = {}
+        # Device receiving the values written to the output register, see outputs.py
+        self.output = out.PrintSink()
+        # Counters of exec_prog runs, see set_profiler
+        self.profiler = None
+        # Handlers run one instruction at a time when profiling or tracing, see compile_stepped
+        self.stepped = None
+        # Changes made by each micro instruction, to run backwards, see set_journal
+        self.journal = None
+        # Writer of the trace records, see set_tracer
+        self.tracer = None
+        # Memory contents at the last view, to show what changed since
+        self.ram_view = mv.MemoryView(self.ram, self.DEFAULT_RAM)
+        self.rom_view = mv.MemoryView(self.rom, self.DEFAULT_ROM)
+        # Pages of RAM written since the last view, marked by every RAM write
+        self.ram_dirty = self.ram_view.dirty
         self.reset()
 
     def reset(self):
-        self.reg_a = '00'
-        self.reg_b = '00'
-        self.reg_c = '00'
-        self.reg_d = '00'
-        self.reg_o = '00'
-        self.bus = ''
-        self.ram_low = '00'
-        self.ram_high = '00'
+        self.reg_a = 0
+        self.reg_b = 0
+        self.reg_c = 0
+        self.reg_d = 0
+        self.reg_o = 0
+        self.bus = 0
+        self.ram_low = 0
+        self.ram_high = 0
         self.ram_ptr = 0
-        self.ram = {}
-        self.pc_low = '00'
-        self.pc_high = '00'
+        self.ram[:] = bytearray([self.DEFAULT_RAM]) * self.MEM_SIZE
+        self.ram_view.mark(0, self.MEM_SIZE)
+        self.pc_low = 0
+        self.pc_high = 0
         self.pc_ptr = 0
         self.carry_flag = False
         self.equal_flag = False
         self.halted = False
         self.init_microcode()
         self.no_op_count = 0
+        self.cycles = 0
+        self.instructions = 0
+        self.clear_journal()
 
     def init_microcode(self):
         self.mic = 0
+        self.instr_pc = self.pc_ptr
         self.set_current_mcode(self.get_rom())
 
     def program_cpu(self, microcode):
         self.microcode = microcode
+        self.fused = compile_microcode(microcode) if microcode else None
+        self.clear_blocks()
+        self.compile_stepped()
+
+    def set_profiler(self, option):
+        'Count where the cycles of exec_prog runs go in self.profiler'
+        if not option:
+            self.profiler = None
+        elif not self.microcode:
+            print('Profiling needs the microcode header')
+        else:
+            self.profiler = prof.Profiler(self.rom)
+        self.compile_stepped()
+
+    def compile_stepped(self):
+        '''Compile the handlers counting RAM accesses for the profiler or writing trace records, checking
+        the accesses against the watchpoints if any. None are needed (and translated blocks run) when both are off'''
+        watching = bool(self.watch_reads or self.watch_writes)
+        if watching != self.block_watch:
+            # Blocks translated before check their accesses only if there were watchpoints then
+            self.block_watch = watching
+            self.clear_blocks()
+        if not self.microcode or not (self.profiler or self.tracer):
+            self.stepped = None
+            return
+        out_source, in_source = (PROFILE_OUT, PROFILE_IN) if self.profiler else (MICRO_OUT, MICRO_IN)
+        if watching:
+            out_source, in_source = watch_source(out_source, in_source)
+        self.stepped = compile_microcode(self.microcode, out_source, in_source, self.defines if self.tracer else None)
+
+    def set_tracer(self, file_name):
+        'Write a record of every micro instruction run in file_name (see tracer.py), stop tracing if None'
+        if self.tracer:
+            count = self.tracer.count()
+            self.tracer.close()
+            print('Wrote', count, 'trace records in file', self.tracer.file_name)
+            self.tracer = None
+        if file_name:
+            if not self.defines:
+                self.defines = read_defines(SRC_MICROCODE)
+            self.tracer = tr.TraceWriter(file_name, control_names(self.defines))
+        self.compile_stepped()
+
+    def set_journal(self, option, size=jour.JOURNAL_SIZE):
+        'Record the changes made by the last size micro instructions run, to step backwards'
+        self.journal = jour.Journal(self.JOURNAL_FIELDS, size) if option else None
+
+    def clear_journal(self):
+        'Forget the steps recorded, after the state was changed by other means than running'
+        if self.journal:
+            self.journal.clear()
+
+    def rewind_microinstr(self):
+        'Undo the last micro instruction recorded, return False when there is none'
+        if not self.journal or not self.journal.rewind(self):
+            return False
+        # Pick the microcode of the instruction running then
+        self.set_mcode_state(*self.mcode_state())
+        return True
+
+    def rewind_instr(self):
+        'Undo micro instructions back to the start of the current instruction, or of the previous one if at its start'
+        if not self.rewind_microinstr():
+            return False
+        while not self.journal.at_instr_start():
+            self.rewind_microinstr()
+        return True
+
+    def rewind_to_break(self):
+        'Undo instructions until the start of one at a breakpoint, return False when running out of steps recorded'
+        while self.rewind_instr():
+            if self.pc_ptr in self.break_pts and self.break_pts[self.pc_ptr].matches(self):
+                return True
+        return False
 
     def split_code(self, code):
         btc = ''
@@ -264,9 +628,7 @@ class Cpu():
         elif btc == 'RI':  # Ram Write
             self.set_ram(self.bus)
         elif btc == 'OI':  # Output Reg clk
-            self.reg_o = self.bus
-            if not self.debug:
-                print('Output=', self.reg_o, '(', int(self.reg_o, 16), ')')
+            self.set_output(self.bus)
         elif btc == 'RLI': # Ram Low Addr clk
             self.set_ram_addr(self.bus, 'LOW')
         elif btc == 'RHI': # Ram High Addr clk
@@ -280,97 +642,237 @@ class Cpu():
 
         # Other instructions given as bus to chip
         elif btc == 'FI': # Set Flags
-            # Set equal flag depending on result in bus
-            if self.bus == 'ff':
-                self.equal_flag = True
-            else:
-                self.equal_flag = False
-            # Set carry flag depending on operation and reg_a and reg_b
-            val_a = int(self.reg_a, 16)
-            val_b = int(self.reg_b, 16)
-            if ctb == 'ADD':
-                self.carry_flag = (val_a + val_b) > 255
-            elif ctb == 'SUB':
-                self.carry_flag = val_a >= val_b
-            elif ctb == 'INC': # ALU Decrement out
-                self.bus = (val_a + 1) > 255
-            elif ctb == 'DEC':
-                self.carry_flag = val_a >= 1
-            else:
-                self.carry_flag = False
+            self.set_flags(ctb)
+
+    def set_flags(self, oper):
+        # Set equal flag depending on result in bus
+        self.equal_flag = self.bus == 0xff
+        # Set carry flag depending on operation and reg_a and reg_b
+        val_a = self.reg_a
+        val_b = self.reg_b
+        if oper == 'ADD':
+            self.carry_flag = (val_a + val_b) > 255
+        elif oper == 'SUB':
+            self.carry_flag = val_a >= val_b
+        elif oper == 'INC':
+            self.carry_flag = (val_a + 1) > 255
+        elif oper == 'DEC':
+            self.carry_flag = val_a >= 1
+        else:
+            self.carry_flag = False
+
+    def set_output(self, value):
+        self.reg_o = value
+        # The debug listing already shows the output register
+        if not self.debug or not isinstance(self.output, out.PrintSink):
+            self.output.write(value)
+
+    def set_output_sink(self, sink):
+        'Send the output values to sink, flushing the previous one'
+        self.output.flush()
+        self.output = sink
 
     def get_ram(self):
-        if self.ram_ptr in self.ram:
-            return self.ram[self.ram_ptr]
-        else:
-            return self.DEFAULT_RAM
+        value = self.ram[self.ram_ptr]
+        if self.ram_ptr in self.watch_reads:
+            self.watch_hit(self.ram_ptr, value, False)
+        return value
 
     def set_ram(self, value):
         self.ram[self.ram_ptr] = value
+        self.ram_dirty[self.ram_ptr >> 8] = 1
+        if self.ram_ptr in self.watch_writes:
+            self.watch_hit(self.ram_ptr, value, True)
 
     def set_ram_addr(self, value, pos):
         if pos == 'LOW':
             self.ram_low = value
         elif pos == 'HIGH':
             self.ram_high = value
-        self.ram_ptr = int(self.ram_high, 16) * 256 + int(self.ram_low, 16)
+        self.ram_ptr = (self.ram_high << 8) | self.ram_low
 
     def get_rom(self):
-        if self.pc_ptr in self.rom:
-            return self.rom[self.pc_ptr]
-        else:
-            return self.DEFAULT_ROM
+        return self.rom[self.pc_ptr]
 
     def burn_rom(self, address, value):
+        self.unshare_rom()
         self.rom[address] = value
+        self.rom_view.mark(address)
+        self.invalidate_blocks(address, address + 1)
 
     def set_pc(self, value, pos):
         if pos == 'LOW':
-            self.pc_low = value.zfill(2)
+            self.pc_low = value
         elif pos == 'HIGH':
-            self.pc_high = value.zfill(2)
-        self.pc_ptr = int(self.pc_high, 16) * 256 + int(self.pc_low, 16)
+            self.pc_high = value
+        self.pc_ptr = (self.pc_high << 8) | self.pc_low
 
     def get_alu(self, oper):
-        val_a = int(self.reg_a, 16)
-        val_b = int(self.reg_b, 16)
+        val_a = self.reg_a
+        val_b = self.reg_b
         if oper == 'ADD':
-            res = self.dec_to_hex((val_a + val_b) % 256)
+            res = (val_a + val_b) & 0xff
         elif oper == 'SUB':
-            res = self.dec_to_hex((val_a - val_b) % 256)
+            res = (val_a - val_b) & 0xff
         elif oper == 'NAND':
-            # TODO
-            res = self.reg_a
+            res = ~(val_a & val_b) & 0xff
         elif oper == 'DEC':
-            res = self.dec_to_hex((val_a - 1) % 256)
+            res = (val_a - 1) & 0xff
         elif oper == 'INC':
-            res = self.dec_to_hex((val_a + 1) % 256)
+            res = (val_a + 1) & 0xff
         return res
 
     def dec_to_hex(self, value, places=2):
         return hex(value)[2:].zfill(places)
 
     def pc_inc(self):
-        value_low = int(self.pc_low, 16)
-        value_hi = int(self.pc_high, 16)
-        value_low = value_low + 1
-        if value_low == 256:
-            value_low = 0
-            value_hi = value_hi + 1
-        self.pc_low = hex(value_low)[2:].zfill(2)
-        self.pc_high = hex(value_hi)[2:].zfill(2)
-        self.pc_ptr = int(self.pc_high, 16) * 256 + int(self.pc_low, 16)
+        self.pc_ptr = (self.pc_ptr + 1) & 0xffff
+        self.pc_high = self.pc_ptr >> 8
+        self.pc_low = self.pc_ptr & 0xff
 
     def load_rom(self, program):
-        for address in program:
-            prog_bytes = [program[address][i:i+2] for i in range(0, len(program[address]), 2)]
-            self.load_code(address, prog_bytes)
+        'Load the {address: code} program, code as a hex string or bytes'
+        for address, code in program.items():
+            self.load_code(address, bytes.fromhex(code) if isinstance(code, str) else code)
+        self.init_microcode()
+        self.clear_journal()
+
+    def clear_rom(self):
+        self.unshare_rom()
+        self.rom[:] = bytearray([self.DEFAULT_ROM]) * self.MEM_SIZE
+        self.rom_view.mark(0, self.MEM_SIZE)
+        self.clear_blocks()
         self.init_microcode()
 
     def load_code(self, address, code):
-        cur_addr = address
-        for index in range(len(code)):
-            self.burn_rom(address + index, code[index])
+        self.unshare_rom()
+        self.rom[address:address + len(code)] = code
+        self.rom_view.mark(address, address + len(code))
+        self.invalidate_blocks(address, address + len(code))
+
+    def get_block(self, key):
+        'Return the translated block for (flags << 16 | pc), translating it if needed'
+        block = self.blocks.get(key)
+        if block is None:
+            block = translate_block(self.microcode, self.rom, key & 0xffff, key >> 16, self.break_pts, self.block_watch)
+            if block is None:
+                return None
+            self.blocks[key] = block
+            for page in range(block.start >> 6, ((block.end - 1) >> 6) + 1):
+                self.block_pages.setdefault(page, set()).add(key)
+        return block
+
+    def invalidate_blocks(self, start, end):
+        'Drop the translated blocks covering ROM addresses start to end - 1'
+        removed = False
+        for page in range(start >> 6, ((end - 1) >> 6) + 1):
+            for key in self.block_pages.pop(page, ()):
+                removed = self.blocks.pop(key, None) is not None or removed
+        if removed:
+            # Chains may point to removed blocks
+            for block in self.blocks.values():
+                block.chain.clear()
+
+    def clear_blocks(self):
+        self.blocks = {}
+        self.block_pages = {}
+
+    def unshare_rom(self):
+        'Take a copy of a ROM shared with forks before changing it or its breakpoints'
+        if self.rom_shared:
+            self.rom = bytearray(self.rom)
+            self.rom_shared = False
+            # Blocks chain to each other, so they cannot be shared once the ROMs differ
+            self.clear_blocks()
+            if self.profiler:
+                self.profiler.rom = self.rom
+
+    def fork(self, output=None):
+        '''Return a copy of the CPU that runs on its own from the current state
+        RAM is copied, ROM and translated blocks are shared until either CPU changes them'''
+        clone = copy.copy(self)
+        clone.ram = bytearray(self.ram)
+        clone.break_pts = {addr: copy.copy(breakpoint) for addr, breakpoint in self.break_pts.items()}
+        clone.watch_reads = dict(self.watch_reads)
+        clone.watch_writes = dict(self.watch_writes)
+        clone.profiler = None
+        clone.tracer = None
+        clone.compile_stepped()
+        clone.journal = None
+        clone.ram_view = mv.MemoryView(clone.ram, self.DEFAULT_RAM)
+        clone.rom_view = mv.MemoryView(clone.rom, self.DEFAULT_ROM)
+        clone.ram_dirty = clone.ram_view.dirty
+        if output is not None:
+            clone.output = output
+        self.rom_shared = clone.rom_shared = True
+        return clone
+
+    def mcode_state(self):
+        'Return the instruction and flags version the current microcode was picked with'
+        return self.cur_instr, self.cur_version
+
+    def set_mcode_state(self, instr, version):
+        self.cur_mcode = self.microcode[MICRO_VERSIONS[version]][self.dec_to_hex(instr)]
+        self.cur_instr = instr
+        self.cur_version = version
+
+    def snapshot(self):
+        'Return the complete CPU state as bytes, see restore'
+        instr, version = self.mcode_state()
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                      self.reg_a, self.reg_b, self.reg_c, self.reg_d, self.reg_o, self.bus,
+                                      self.ram_low, self.ram_high, self.pc_low, self.pc_high,
+                                      self.carry_flag, self.equal_flag, self.halted,
+                                      self.mic, instr, version, self.no_op_count, self.cycles, self.instructions)
+        return header + self.ram + self.rom
+
+    def restore(self, snapshot):
+        'Set the CPU state saved by snapshot'
+        if len(snapshot) != SNAPSHOT_HEADER.size + 2 * self.MEM_SIZE or snapshot[:4] != SNAPSHOT_MAGIC:
+            raise ValueError('Not a CPU snapshot')
+        fields = SNAPSHOT_HEADER.unpack_from(snapshot)
+        if fields[1] != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version ' + str(fields[1]))
+        (self.reg_a, self.reg_b, self.reg_c, self.reg_d, self.reg_o, self.bus,
+         self.ram_low, self.ram_high, self.pc_low, self.pc_high,
+         self.carry_flag, self.equal_flag, self.halted,
+         self.mic, instr, version, self.no_op_count, self.cycles, self.instructions) = fields[2:]
+        self.ram_ptr = (self.ram_high << 8) | self.ram_low
+        self.pc_ptr = (self.pc_high << 8) | self.pc_low
+        data = memoryview(snapshot)
+        start = SNAPSHOT_HEADER.size
+        self.ram[:] = data[start:start + self.MEM_SIZE]
+        self.ram_view.mark(0, self.MEM_SIZE)
+        rom = data[start + self.MEM_SIZE:]
+        # Restoring in the same program keeps its translated blocks
+        if self.rom != rom:
+            self.unshare_rom()
+            self.rom[:] = rom
+            self.rom_view.mark(0, self.MEM_SIZE)
+            self.clear_blocks()
+        self.set_mcode_state(instr, version)
+        self.clear_journal()
+
+    def save_snapshot(self, file_name):
+        try:
+            with open(file_name, 'wb') as out_file:
+                out_file.write(zlib.compress(self.snapshot(), 1))
+            print('Wrote CPU snapshot in file', file_name)
+            return True
+        except IOError:
+            print('Cannot open file', file_name)
+            return False
+
+    def load_snapshot(self, file_name):
+        try:
+            with open(file_name, 'rb') as input_file:
+                self.restore(zlib.decompress(input_file.read()))
+            return True
+        except IOError:
+            print('Cannot open file', file_name)
+        except (zlib.error, ValueError) as error:
+            print('Invalid CPU snapshot in file', file_name, '(' + str(error) + ')')
+        return False
 
     # def exec_instr(self):
         # Execute all microcode
@@ -378,39 +880,83 @@ class Cpu():
             # pass
 
     def exec_one_microinstr(self):
+        'Run a micro instruction, False when the current instruction was done and the next one got loaded'
+        if self.journal or self.tracer:
+            return self.exec_recorded()
+        return self.step_microinstr()
+
+    def exec_recorded(self):
+        'Run a micro instruction recording it in the journal and the trace, whichever are on'
+        cycles = self.cycles
+        mic = self.mic
+        # Records hold the address and code of the instruction, the CLR step loads the next one
+        instr_pc = self.instr_pc
+        opcode = self.current_opcode()
+        ctrl = self.control_byte() if self.tracer else None
+        more = self.journal.record(self) if self.journal else self.step_microinstr()
+        if self.tracer and self.cycles != cycles:
+            self.tracer.write(cycles, instr_pc, self.current_opcode() if more else opcode, mic, ctrl, self.bus,
+                              self.reg_a, self.reg_b, self.reg_c, self.reg_d, self.reg_o,
+                              self.carry_flag | self.equal_flag << 1 | self.halted << 2, self.ram_ptr)
+        return more
+
+    def control_byte(self):
+        'Return the control byte of the micro instruction to run next'
+        if self.mic < len(self.cur_mcode):
+            return control_word(self.cur_mcode[self.mic], self.defines)
+        if clear_cycles(self.cur_mcode):
+            return control_word('CLR', self.defines)
+        return 0xff
+
+    def current_opcode(self):
+        return self.cur_instr
+
+    def step_microinstr(self):
         if self.mc_debug:
             self.print_mcode_status()
         if self.mic < len(self.cur_mcode):
             self.chip_to_bus(self.cur_mcode[self.mic])
             self.bus_to_chip(self.cur_mcode[self.mic])
             self.mic = self.mic + 1
+            self.cycles = self.cycles + 1
             return True
         else:
-            # Check if pc is a breakpoint
-            if self.pc_ptr in self.break_pts:
-                print('Found breakpoint at address')
-                print('PC Addr=', self.pc_ptr, '(', self.pc_high, self.pc_low, ') ->', self.get_rom(), '=', asm.get_instr_from_code(self.get_rom()))
-                self.halt()
-            # Current microcode is done:
+            # Current microcode is done, as the CLR step on the hardware:
             # - Retrieve next instruction as pointed by pc_ptr
             # - Reset mic
-            instr = self.get_rom()
-            if self.debug:
-                print('Loading instruction=', instr, '=', asm.get_instr_from_code(self.get_rom()))
-            # Fuse to avoid infinite loops
-            if instr == 'ff':
-                self.no_op_count = self.no_op_count + 1
-                if self.no_op_count > self.NO_OP_MAX:
-                    self.halt()
-                    print('Executed more that', self.NO_OP_MAX, 'NOP instructions, halting...')
-            else:
-                self.no_op_count = 0
+            self.cycles = self.cycles + clear_cycles(self.cur_mcode)
+            self.instructions = self.instructions + 1
+            instr = self.next_instr()
             # Initialize current microcode
             self.set_current_mcode(instr)
             return False
 
+    def next_instr(self):
+        'Check the instruction at pc_ptr before it gets executed'
+        self.instr_pc = self.pc_ptr
+        # Check if pc is a breakpoint
+        if self.pc_ptr in self.break_pts and self.break_pts[self.pc_ptr].reached(self):
+            print('Found breakpoint at address')
+            self.print_pc()
+            self.halt()
+        instr = self.get_rom()
+        if self.debug:
+            print('Loading instruction=', self.dec_to_hex(instr), '=', asm.get_instr_from_code(self.dec_to_hex(instr)))
+        # Fuse to avoid infinite loops
+        if instr == 0xff:
+            self.no_op_count = self.no_op_count + 1
+            if self.no_op_count > self.NO_OP_MAX:
+                self.halt()
+                print('Executed more that', self.NO_OP_MAX, 'NOP instructions, halting...')
+        else:
+            self.no_op_count = 0
+        return instr
+
     def set_current_mcode(self, instr):
         self.cur_mcode = self.get_microcode(instr)
+        # Kept to pick the same microcode again when restoring a snapshot
+        self.cur_instr = instr
+        self.cur_version = self.equal_flag << 1 | self.carry_flag
         if self.mc_debug:
             print('Setting mCode=', self.cur_mcode)
         self.mic = 0
@@ -424,18 +970,123 @@ class Cpu():
             version = 'flaggedEqual'
         if self.carry_flag and self.equal_flag:
             version = 'flaggedBoth'
-        return self.microcode[version][instr]
+        return self.microcode[version][self.dec_to_hex(instr)]
 
-    def exec_prog(self):
+    def exec_prog(self, max_cycles=None):
+        '''Run until halted, or until max_cycles micro instructions have been executed
+        Translated blocks are run to their end, so a few more cycles may be run'''
         print('Starting execution of program')
-        # Run instructions until halted
-        while not self.halted:
-            self.exec_one_instr()
+        limit = self.cycles + max_cycles if max_cycles is not None else float('inf')
+        try:
+            if self.clock_period > 0:
+                self.exec_paced(limit)
+            else:
+                self.exec_until(limit)
+        finally:
+            self.output.flush()
+            if self.tracer:
+                self.tracer.flush()
+
+    def exec_until(self, limit):
+        'Run at full speed until halted or the cycle count reaches limit'
+        if not self.fused or self.debug or self.mc_debug or self.journal:
+            # Run instructions until halted
+            while not self.halted and self.cycles < limit:
+                self.run_instr()
+            return
+        # Finish an instruction left halfway by mstep
+        if self.mic > 0 and not self.halted:
+            self.run_instr()
+        if self.halted:
+            return
+        if self.stepped:
+            self.exec_stepped(limit)
+            return
+        # Run translated blocks until halted, each block chaining to the next
+        next_instr = self.next_instr
+        get_block = self.get_block
+        key = ((self.equal_flag << 1 | self.carry_flag) << 16) | self.pc_ptr
+        block = None
+        check = False
+        while not self.halted and self.cycles < limit:
+            next_block = block.chain.get(key) if block else None
+            if next_block is None:
+                next_block = get_block(key)
+                if next_block is None:
+                    # Not translatable, the fused handler raises for undefined opcodes
+                    self.fused[((key >> 16) << 8) | self.get_rom()](self)
+                if block:
+                    block.chain[key] = next_block
+            block = next_block
+            # Breakpoints and NOPs only start blocks, the first one was checked when stopping
+            if check and block.stop:
+                next_instr()
+                if self.halted:
+                    break
+            check = True
+            key = block.run(self)
+        else:
+            next_instr()
+        self.set_current_mcode(self.get_rom())
+
+    def exec_stepped(self, limit):
+        'Run instructions one at a time with the stepped handlers, recording each one in the profiler if on'
+        profiler = self.profiler
+        handlers = self.stepped
+        rom = self.rom
+        while not self.halted and self.cycles < limit:
+            pc = self.pc_ptr
+            instr = rom[pc]
+            cycles = handlers[((self.equal_flag << 1 | self.carry_flag) << 8) | instr](self)
+            self.cycles = self.cycles + cycles
+            self.instructions = self.instructions + 1
+            if profiler:
+                profiler.record(pc, instr, cycles, self.pc_ptr)
+            self.next_instr()
+        self.set_current_mcode(self.get_rom())
+
+    def exec_paced(self, limit):
+        '''Run at the clock_period pace until halted or the cycle count reaches limit
+        Cycles due are run in bursts at full speed, sleeping when ahead of time'''
+        clock = Clock(self.clock_period, self.cycles)
+        try:
+            # Halting only stops a run once the instruction is done
+            while (not self.halted or self.mic > 0) and self.cycles < limit:
+                budget = min(clock.wait(self.cycles), limit - self.cycles)
+                if budget >= Clock.BURST_MIN and not self.halted:
+                    self.exec_until(self.cycles + budget)
+                else:
+                    self.exec_cycles(budget)
+        finally:
+            clock.print_frequency(self.cycles)
+
+    def exec_cycles(self, count):
+        'Run count micro instructions, stopping at the end of an instruction after halting'
+        end = self.cycles + count
+        while self.cycles < end:
+            if not self.exec_one_microinstr():
+                if self.debug:
+                    self.print_cpu()
+                if self.halted:
+                    return
 
     def exec_one_instr(self):
+        'Run the rest of the current instruction at the clock_period pace'
+        if self.clock_period <= 0:
+            self.run_instr()
+            return
+        clock = Clock(self.clock_period, self.cycles)
+        while True:
+            clock.wait(self.cycles)
+            if not self.exec_one_microinstr():
+                break
+        if self.debug:
+            self.print_cpu()
+
+    def run_instr(self):
+        'Run the rest of the current instruction at full speed'
         while self.exec_one_microinstr():
-            if self.clock_period > 0:
-                time.sleep(self.clock_period)
+            pass
         if self.debug:
             self.print_cpu()
 
@@ -451,15 +1102,53 @@ class Cpu():
     def set_mc_debug(self, option):
         self.mc_debug = option
 
-    def set_break(self, addr):
-        self.break_pts.add(addr)
+    def set_break(self, addr, condition=None):
+        'Stop before running the instruction at addr, if condition (see Breakpoint) is true'
+        breakpoint = Breakpoint(addr, condition)
+        self.unshare_rom()
+        self.break_pts[addr] = breakpoint
+        # Blocks running over the address have to be split
+        self.invalidate_blocks(addr, addr + 1)
 
     def clr_break(self, addr):
         if addr in self.break_pts:
-            self.break_pts.remove(addr)
+            self.unshare_rom()
+            del self.break_pts[addr]
+            self.invalidate_blocks(addr, addr + 1)
 
     def reset_breaks(self):
-        self.break_pts = set()
+        self.unshare_rom()
+        self.break_pts = {}
+        self.clear_blocks()
+
+    def set_watch(self, start, end=None, read=False, write=True):
+        'Stop after an instruction reading or writing RAM addresses start to end'
+        watchpoint = Watchpoint(start, start if end is None else end, read, write)
+        for addr in range(watchpoint.start, watchpoint.end + 1):
+            if read:
+                self.watch_reads[addr] = watchpoint
+            if write:
+                self.watch_writes[addr] = watchpoint
+        self.compile_stepped()
+
+    def clr_watch(self, start):
+        for watches in (self.watch_reads, self.watch_writes):
+            for addr in [addr for addr, watchpoint in watches.items() if watchpoint.start == start]:
+                del watches[addr]
+        self.compile_stepped()
+
+    def reset_watches(self):
+        self.watch_reads = {}
+        self.watch_writes = {}
+        self.compile_stepped()
+
+    def watch_hit(self, addr, value, write):
+        'Halt once the running instruction is done, called on accesses to watched RAM addresses'
+        watchpoint = (self.watch_writes if write else self.watch_reads)[addr]
+        watchpoint.hits = watchpoint.hits + 1
+        print('Watchpoint', 'write' if write else 'read', 'at RAM address', self.dec_to_hex(addr, 4), '=', self.dec_to_hex(value),
+              'by instruction at', self.dec_to_hex(self.instr_pc, 4))
+        self.halt()
 
     def print_mcode_status(self):
         print('--------------------------------')
@@ -467,28 +1156,55 @@ class Cpu():
         print('Current mcode =', list(enumerate(self.cur_mcode)))
 
     def print_regs_flags(self):
+        h = self.dec_to_hex
         print('--------------------------------')
-        print('Reg A=', self.reg_a, '(', int(self.reg_a, 16), ')  Reg B=', self.reg_b, '(', int(self.reg_b, 16), ')')
-        print('Reg C=', self.reg_c, '(', int(self.reg_c, 16), ')  Reg D=', self.reg_d, '(', int(self.reg_d, 16), ')')
-        print('Output Reg=', self.reg_o, '(', int(self.reg_o, 16), ')')
-        print('Bus data=', self.bus, '(', int(self.reg_o, 16), ')')
+        print('Reg A=', h(self.reg_a), '(', self.reg_a, ')  Reg B=', h(self.reg_b), '(', self.reg_b, ')')
+        print('Reg C=', h(self.reg_c), '(', self.reg_c, ')  Reg D=', h(self.reg_d), '(', self.reg_d, ')')
+        print('Output Reg=', h(self.reg_o), '(', self.reg_o, ')')
+        print('Bus data=', h(self.bus), '(', self.bus, ')')
         print('Carry and Equal flags=', self.carry_flag, ',', self.equal_flag)
 
+    def print_memory(self, name, memory, view, address):
+        'Print the pages of memory in use and the rows changed since the last view, or the row at address'
+        print(name, 'pages in use=', mv.format_pages(view.used_pages(memory)) or 'none')
+        rows = view.changed_rows(memory)
+        if len(rows) > self.CHANGED_ROWS:
+            print(view.render_rows(memory, rows[:self.CHANGED_ROWS]))
+            print(len(rows) - self.CHANGED_ROWS, 'more rows changed, use diff to see them')
+        else:
+            print(view.render_rows(memory, rows) if rows else view.render(memory, address, 1))
+        view.update(memory)
+
+    def print_pc(self):
+        h = self.dec_to_hex
+        print('PC Addr=', self.pc_ptr, '(', h(self.pc_high), h(self.pc_low), ') ->', h(self.get_rom()), '=', asm.get_instr_from_code(h(self.get_rom())))
+
     def print_ram(self):
+        h = self.dec_to_hex
         print('--------------------------------')
-        print('RAM Addr=', self.ram_ptr, '(', self.ram_high, self.ram_low, ') ->', self.get_ram())
-        print('RAM')
-        print(self.ram)
+        print('RAM Addr=', self.ram_ptr, '(', h(self.ram_high), h(self.ram_low), ') ->', h(self.ram[self.ram_ptr]))
+        self.print_memory('RAM', self.ram, self.ram_view, self.ram_ptr)
 
     def print_rom(self):
         print('--------------------------------')
-        print('PC Addr=', self.pc_ptr, '(', self.pc_high, self.pc_low, ') ->', self.get_rom(), '=', asm.get_instr_from_code(self.get_rom()))
-        print('ROM')
-        print(self.rom)
+        self.print_pc()
+        self.print_memory('ROM', self.rom, self.rom_view, self.pc_ptr)
+
+    def print_diff(self):
+        'Print every RAM and ROM row changed since the last view'
+        for name, memory, view in (('RAM', self.ram, self.ram_view), ('ROM', self.rom, self.rom_view)):
+            rows = view.changed_rows(memory)
+            print(name, len(rows), 'rows changed')
+            if rows:
+                print(view.render_rows(memory, rows))
+            view.update(memory)
 
     def print_breaks(self):
         print('--------------------------------')
-        print('Breaks =', ', '.join([ str(x) + '(' + self.dec_to_hex(x, 4) + 'h)' for x in sorted(self.break_pts)]))
+        print('Breaks =', ', '.join([str(self.break_pts[x]) for x in sorted(self.break_pts)]))
+        watchpoints = set(self.watch_reads.values()) | set(self.watch_writes.values())
+        if watchpoints:
+            print('Watches =', ', '.join([str(x) for x in sorted(watchpoints, key=lambda x: x.start)]))
 
     def print_cpu(self):
         print('================================')
@@ -500,6 +1216,226 @@ class Cpu():
         self.print_breaks()
         print('================================')
 
+class Clock():
+    'Keeps a run in step with a clock of the given period (s) by setting a deadline for each cycle'
+
+    # Time (s) of the longest burst of cycles run without looking at the clock
+    BURST_TIME = 0.01
+    # Bursts shorter than this (cycles) are stepped one micro instruction at a time
+    BURST_MIN = 64
+
+    def __init__(self, period, cycles=0):
+        self.period = period
+        self.start_cycles = cycles
+        self.start_time = time.perf_counter()
+
+    def wait(self, cycles):
+        'Sleep until the next cycle is due and return how many cycles can be run now'
+        done = cycles - self.start_cycles
+        while True:
+            elapsed = time.perf_counter() - self.start_time
+            # Cycle n is due at n * period, running late catches up in bursts
+            due = int(elapsed / self.period) + 1 - done
+            if due > 0:
+                return min(due, max(1, int(self.BURST_TIME / self.period)))
+            time.sleep(done * self.period - elapsed)
+
+    def frequency(self, cycles):
+        elapsed = time.perf_counter() - self.start_time
+        return (cycles - self.start_cycles) / elapsed if elapsed > 0 else 0
+
+    def print_frequency(self, cycles):
+        print('Clock target', format_frequency(1 / self.period), 'achieved', format_frequency(self.frequency(cycles)),
+              'over', cycles - self.start_cycles, 'cycles')
+
+def format_frequency(value):
+    for unit, scale in (('MHz', 1e6), ('kHz', 1e3)):
+        if value >= scale:
+            return str(round(value / scale, 3)) + ' ' + unit
+    return str(round(value, 3)) + ' Hz'
+
+class RomCpu(Cpu):
+    'CPU Simulator driven by the control ROM image burned in the EEPROMs'
+
+    STEPS = CONTROL_STEPS
+    NO_CTRL = 0xf
+    JOURNAL_FIELDS = Cpu.JOURNAL_FIELDS[:-2] + ('ir',)
+
+    def __init__(self, control_rom=None, defines=None, clock_period=0, debug=False, mc_debug=False):
+        self.control_rom = control_rom
+        self.ir = 0
+        self.defines = defines
+        self.build_handlers(defines)
+        super().__init__(None, clock_period, debug, mc_debug)
+
+    def build_handlers(self, defines):
+        'Build the 256-entry tables mapping a control byte to its name and handler'
+        out_names, in_names = signal_names(defines)
+        self.clr_nibble = [nibble for nibble in out_names if out_names[nibble] == 'CLR'][0]
+
+        out_handlers = {'AO': self.out_a, 'BO': self.out_b, 'CO': self.out_c, 'DO': self.out_d,
+                        'RO': self.out_ram, 'PO': self.out_rom,
+                        'ADD': self.out_add, 'SUB': self.out_sub, 'NAO': self.out_nand,
+                        'DEC': self.out_dec, 'INC': self.out_inc,
+                        'PIN': self.pc_inc, 'HLT': self.halt}
+        in_handlers = {'AI': self.in_a, 'BI': self.in_b, 'CI': self.in_c, 'DI': self.in_d,
+                       'RI': self.in_ram, 'OI': self.in_out,
+                       'RLI': self.in_ram_low, 'RHI': self.in_ram_high,
+                       'PLI': self.in_pc_low, 'PHI': self.in_pc_high,
+                       'II': self.in_instr}
+
+        self.ctrl_names = control_names(defines)
+        self.ctrl_handlers = []
+        for ctrl in range(256):
+            out_name = out_names.get(ctrl & 0xf)
+            in_name = in_names.get(ctrl >> 4)
+            out_fn = out_handlers.get(out_name)
+            if in_name == 'FI':
+                in_fn = self.flags_handler(out_name)
+            else:
+                in_fn = in_handlers.get(in_name)
+            self.ctrl_handlers.append(self.join_handlers(out_fn, in_fn))
+
+    def flags_handler(self, oper):
+        def handler():
+            self.set_flags(oper)
+        return handler
+
+    def join_handlers(self, out_fn, in_fn):
+        if out_fn and in_fn:
+            def handler():
+                out_fn()
+                in_fn()
+            return handler
+        return out_fn or in_fn or self.no_op
+
+    def no_op(self):
+        pass
+
+    # ----- chip to bus -----
+    def out_a(self):
+        self.bus = self.reg_a
+
+    def out_b(self):
+        self.bus = self.reg_b
+
+    def out_c(self):
+        self.bus = self.reg_c
+
+    def out_d(self):
+        self.bus = self.reg_d
+
+    def out_ram(self):
+        self.bus = self.get_ram()
+
+    def out_rom(self):
+        self.bus = self.rom[self.pc_ptr]
+
+    def out_add(self):
+        self.bus = (self.reg_a + self.reg_b) & 0xff
+
+    def out_sub(self):
+        self.bus = (self.reg_a - self.reg_b) & 0xff
+
+    def out_nand(self):
+        self.bus = ~(self.reg_a & self.reg_b) & 0xff
+
+    def out_dec(self):
+        self.bus = (self.reg_a - 1) & 0xff
+
+    def out_inc(self):
+        self.bus = (self.reg_a + 1) & 0xff
+
+    # ----- bus to chip -----
+    def in_a(self):
+        self.reg_a = self.bus
+
+    def in_b(self):
+        self.reg_b = self.bus
+
+    def in_c(self):
+        self.reg_c = self.bus
+
+    def in_d(self):
+        self.reg_d = self.bus
+
+    def in_ram(self):
+        self.set_ram(self.bus)
+
+    def in_out(self):
+        self.set_output(self.bus)
+
+    def in_ram_low(self):
+        self.set_ram_addr(self.bus, 'LOW')
+
+    def in_ram_high(self):
+        self.set_ram_addr(self.bus, 'HIGH')
+
+    def in_pc_low(self):
+        self.set_pc(self.bus, 'LOW')
+
+    def in_pc_high(self):
+        self.set_pc(self.bus, 'HIGH')
+
+    def in_instr(self):
+        self.ir = self.bus
+
+    # ----- execution -----
+    def init_microcode(self):
+        self.mic = 0
+        self.instr_pc = self.pc_ptr
+
+    def program_cpu(self, control_rom):
+        self.control_rom = control_rom
+        self.fused = None
+
+    def fork(self, output=None):
+        clone = super().fork(output)
+        # The handlers are bound to this CPU
+        clone.build_handlers(self.defines)
+        return clone
+
+    def mcode_state(self):
+        return self.ir, 0
+
+    def control_byte(self):
+        return self.control_rom[self.ctrl_address(self.mic)]
+
+    def current_opcode(self):
+        return self.ir
+
+    def set_mcode_state(self, instr, version):
+        self.ir = instr
+
+    def ctrl_address(self, step):
+        return ((self.equal_flag << 1 | self.carry_flag) << 12) | (self.ir << 4) | step
+
+    def step_microinstr(self):
+        if self.mc_debug:
+            self.print_mcode_status()
+        ctrl = self.control_rom[((self.equal_flag << 1 | self.carry_flag) << 12) | (self.ir << 4) | self.mic]
+        self.ctrl_handlers[ctrl]()
+        self.mic = self.mic + 1
+        self.cycles = self.cycles + 1
+        if (ctrl & 0xf) == self.clr_nibble or self.mic == self.STEPS:
+            # Instruction is done, the next step fetches from pc_ptr
+            self.mic = 0
+            self.instructions = self.instructions + 1
+            self.next_instr()
+            return False
+        return True
+
+    def print_mcode_status(self):
+        steps = []
+        for step in range(self.STEPS):
+            ctrl = self.control_rom[self.ctrl_address(step)]
+            steps.append(self.ctrl_names[ctrl])
+            if (ctrl & 0xf) == self.clr_nibble:
+                break
+        print('--------------------------------')
+        print('Microinstr ctr =', self.mic, 'Instr reg =', self.dec_to_hex(self.ir))
+        print('Current mcode =', list(enumerate(steps)))
+
 def read_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('infile', nargs='?', type=str, default=None, help='Text file with assembler program')
@@ -509,6 +1445,17 @@ def read_args():
     parser.add_argument('-m', '--mcode-debug', action='store_true', help='Print microcode debug information')
     parser.add_argument('-i', '--interactive', action='store_true', help='Show prompt for interactive run')
     parser.add_argument('-p', '--clock-period', type=float, default=0, help='Micro instruction clock period (ms), 0 for full speed')
+    parser.add_argument('-z', '--frequency', type=float, default=0, help='Micro instruction clock frequency (Hz), used instead of the clock period')
+    parser.add_argument('-r', '--control-rom', action='store_true', help='Execute the control ROM image built from the microcode header (see microgen.py) instead of the header')
+    parser.add_argument('--control-rom-file', type=str, default=None, help='Execute the control ROM image in this file (e.g. ../Microcode/data.txt written by microgen.py) instead of the microcode header')
+    parser.add_argument('-f', '--profile', action='store_true', help='Print where the cycles went after the run')
+    parser.add_argument('--profile-json', type=str, default=None, help='JSON file to save the profile in')
+    parser.add_argument('--profile-stacks', type=str, default=None, help='File to save the profile in as collapsed stacks for flame graphs')
+    parser.add_argument('-o', '--output-file', type=str, default=None, help='File to write the output values in instead of printing them')
+    parser.add_argument('--binary-output', action='store_true', help='Write a byte per output value in the output file instead of a text line')
+    parser.add_argument('-u', '--buffered-output', action='store_true', help='Print the output values in batches')
+    parser.add_argument('-t', '--trace', type=str, default=None, help='File to write a record of every micro instruction run in (see tracer.py)')
+    parser.add_argument('-n', '--no-cache', action='store_true', help='Translate the program even if it was translated before')
     return parser.parse_args()
 
 def read_microcode(file_name, debug=False):
@@ -520,6 +1467,9 @@ def read_microcode(file_name, debug=False):
     except IOError:
         print('Cannot open file', file_name)
         return False
+    return parse_microcode(lines, debug)
+
+def parse_microcode(lines, debug=False):
     # Process lines to obtain microcode
     all_code = {}
     code_list = []
@@ -576,7 +1526,529 @@ def read_microcode(file_name, debug=False):
                 print(version, code, microcode[version][code])
     return microcode
 
-if __name__ == '__main__':
+# Python source for each micro-op used by the generated handlers
+# The CPU state they touch is kept in the locals named in CPU_LOCALS
+CPU_LOCALS = {'a': 'reg_a', 'b': 'reg_b', 'c': 'reg_c', 'd': 'reg_d', 'bus': 'bus',
+              'rp': 'ram_ptr', 'rl': 'ram_low', 'rh': 'ram_high',
+              'pc': 'pc_ptr', 'pl': 'pc_low', 'ph': 'pc_high',
+              'cy': 'carry_flag', 'eq': 'equal_flag', 'ram': 'ram', 'rom': 'rom', 'dirty': 'ram_dirty'}
+MICRO_OUT = {'AO': ['bus = a'],
+             'BO': ['bus = b'],
+             'CO': ['bus = c'],
+             'DO': ['bus = d'],
+             'RO': ['bus = ram[rp]'],
+             'PO': ['bus = rom[pc]'],
+             'ADD': ['bus = (a + b) & 0xff'],
+             'SUB': ['bus = (a - b) & 0xff'],
+             'NAO': ['bus = ~(a & b) & 0xff'],
+             'DEC': ['bus = (a - 1) & 0xff'],
+             'INC': ['bus = (a + 1) & 0xff'],
+             'PIN': ['pc = (pc + 1) & 0xffff', 'ph = pc >> 8', 'pl = pc & 0xff'],
+             'HLT': ['cpu.halted = True'],
+             'NOP': [],
+             }
+MICRO_IN = {'AI': ['a = bus'],
+            'BI': ['b = bus'],
+            'CI': ['c = bus'],
+            'DI': ['d = bus'],
+            'RI': ['ram[rp] = bus', 'dirty[rp >> 8] = 1'],
+            'OI': ['cpu.reg_o = bus', 'cpu.output.write(bus)'],
+            'RLI': ['rl = bus', 'rp = (rh << 8) | bus'],
+            'RHI': ['rh = bus', 'rp = (bus << 8) | rl'],
+            'PLI': ['pl = bus', 'pc = (ph << 8) | bus'],
+            'PHI': ['ph = bus', 'pc = (bus << 8) | pl'],
+            'II': [],
+            '': [],
+            }
+MICRO_CARRY = {'ADD': 'cy = (a + b) > 255',
+               'SUB': 'cy = a >= b',
+               'INC': 'cy = (a + 1) > 255',
+               'DEC': 'cy = a >= 1',
+               }
+# Micro-ops of the handlers used when profiling
+PROFILE_OUT = dict(MICRO_OUT, RO=['bus = ram[rp]', 'cpu.profiler.ram_reads[rp] += 1'])
+PROFILE_IN = dict(MICRO_IN, RI=MICRO_IN['RI'] + ['cpu.profiler.ram_writes[rp] += 1'])
+
+MICRO_VERSIONS = ['base', 'flaggedCarry', 'flaggedEqual', 'flaggedBoth']
+BLOCK_MAX = 64
+
+def split_micro(code):
+    ctb, btc = (code.split('&') + [''])[:2]
+    return ctb.strip(), btc.strip()
+
+def watch_source(out_source, in_source):
+    'Return out_source and in_source with their RAM accesses checked against the watchpoints'
+    return (dict(out_source, RO=out_source['RO'] + ['if rp in cpu.watch_reads: cpu.watch_hit(rp, bus, False)']),
+            dict(in_source, RI=in_source['RI'] + ['if rp in cpu.watch_writes: cpu.watch_hit(rp, bus, True)']))
+
+def micro_source(seq, pc=None, rom=None, out_source=MICRO_OUT, in_source=MICRO_IN):
+    '''Return the Python lines, cycle count, pc and ROM extent of a microcode sequence
+    If pc is given, ROM reads and increments are resolved at translation time until
+    the sequence writes the pc (None is returned then) and the extent is one past
+    the last ROM address read
+    out_source and in_source give the lines of each micro-op'''
+    body = []
+    cycles = clear_cycles(seq)
+    end = 0
+    for code in seq:
+        cycles = cycles + 1
+        ctb, btc = split_micro(code)
+        if ctb == 'CLR':
+            break
+        if pc is not None and ctb == 'PO':
+            body.append('bus = ' + hex(rom[pc]))
+            end = max(end, pc + 1)
+        elif pc is not None and ctb == 'PIN':
+            pc = (pc + 1) & 0xffff
+        else:
+            body.extend(out_source[ctb])
+        if pc is not None and btc in ('PLI', 'PHI'):
+            body.extend(pc_source(pc))
+            pc = None
+        if btc == 'FI':
+            body.append('eq = bus == 0xff')
+            body.append(MICRO_CARRY.get(ctb, 'cy = False'))
+        else:
+            body.extend(in_source[btc])
+    return body, cycles, pc, end
+
+def clear_cycles(seq):
+    'Return the cycles of the CLR step the control ROM adds after a sequence, 0 if it fills all the steps or has a CLR'
+    if len(seq) >= CONTROL_STEPS or any(split_micro(code)[0] == 'CLR' for code in seq):
+        return 0
+    return 1
+
+def pc_source(pc):
+    return ['pc = ' + hex(pc), 'ph = ' + hex(pc >> 8), 'pl = ' + hex(pc & 0xff)]
+
+# Code objects of the generated handlers, keyed on their body lines
+COMPILED_CODE = {}
+
+def handler_source(body):
+    '''Return the source of a handler function moving the CPU state it uses in and out of locals
+    A line "@EXIT value" stores the state back and returns value'''
+    text = '\n'.join(line for line in body if not line.lstrip().startswith(('#', '@')))
+    used = [local for local in CPU_LOCALS if re.search(r'\b' + local + r'\b', text)]
+    assigned = set(match.group(1) for match in (re.match(r'\s*(\w+) = ', line) for line in body) if match)
+    lines = ['def handler(cpu):']
+    lines.extend('    ' + local + ' = cpu.' + CPU_LOCALS[local] for local in used)
+    for line in body:
+        indent = '    ' + line[:len(line) - len(line.lstrip())]
+        if line.lstrip().startswith('@EXIT '):
+            lines.extend(indent + 'cpu.' + CPU_LOCALS[local] + ' = ' + local for local in used if local in assigned)
+            lines.append(indent + 'return ' + line.lstrip()[6:])
+        else:
+            lines.append('    ' + line)
+    return '\n'.join(lines)
+
+def make_handler(body, name):
+    'Return the compiled handler for body, reusing code compiled before (or loaded from the microcode cache)'
+    text = '\n'.join(body)
+    code = COMPILED_CODE.get(text)
+    if code is None:
+        code = compile(handler_source(body), name, 'exec')
+        COMPILED_CODE[text] = code
+    namespace = {}
+    exec(code, namespace)
+    return namespace['handler']
+
+def fuse_sequence(seq, name='<microcode>', out_source=MICRO_OUT, in_source=MICRO_IN):
+    'Return a handler running a whole microcode sequence and returning its cycles'
+    body, cycles, pc, end = micro_source(seq, out_source=out_source, in_source=in_source)
+    return make_handler(body + ['@EXIT ' + str(cycles)], name)
+
+def trace_sequence(seq, defines, name='<trace>', out_source=MICRO_OUT, in_source=MICRO_IN):
+    'Return a handler like fuse_sequence also writing a trace record (see tracer.py) after each micro-op'
+    body = []
+    cycles = 0
+    if clear_cycles(seq):
+        seq = tuple(seq) + ('CLR',)
+    for code in seq:
+        op_body, op_cycles, op_pc, op_end = micro_source([code], out_source=out_source, in_source=in_source)
+        body.extend(op_body)
+        body.append('pack(mm, pos + %d, cyc + %d, ipc, ins, %d, %d, bus, a, b, c, d, cpu.reg_o, cy | eq << 1 | cpu.halted << 2, rp)'
+                    % (cycles * tr.RECORD.size, cycles, cycles, control_word(code, defines)))
+        cycles = cycles + 1
+        if split_micro(code)[0] == 'CLR':
+            break
+    # Room for all the records is taken once per instruction, as in TraceWriter.reserve
+    start = ['tracer = cpu.tracer', 'pos = tracer.pos', 'tracer.pos = pos + ' + str(cycles * tr.RECORD.size),
+             'if tracer.pos > tracer.end: tracer.grow()',
+             'mm = tracer.mm', 'pack = tracer.pack', 'cyc = cpu.cycles', 'ipc = pc', 'ins = rom[pc]']
+    return make_handler(start + body + ['@EXIT ' + str(cycles)], name)
+
+def compile_microcode(microcode, out_source=MICRO_OUT, in_source=MICRO_IN, defines=None):
+    '''Compile a handler per (flags, opcode) running its whole microcode sequence,
+    writing trace records if the control signal defines are given'''
+    compiled = {}
+    fused = []
+    for version in MICRO_VERSIONS:
+        for instr in range(256):
+            code = hex(instr)[2:].zfill(2)
+            if code not in microcode[version]:
+                fused.append(undefined_handler(code))
+                continue
+            seq = tuple(microcode[version][code])
+            if seq not in compiled and defines:
+                compiled[seq] = trace_sequence(seq, defines, '<trace ' + code + '>', out_source, in_source)
+            elif seq not in compiled:
+                compiled[seq] = fuse_sequence(seq, '<microcode ' + code + '>', out_source, in_source)
+            fused.append(compiled[seq])
+    return fused
+
+def undefined_handler(code):
+    def handler(cpu):
+        raise KeyError(code)
+    return handler
+
+class Block():
+    'Translated run of ROM instructions'
+
+    def __init__(self, handler, start, end, stop):
+        self.run = handler
+        self.start = start
+        self.end = end
+        self.stop = stop
+        self.chain = {}
+
+def ends_block(seq):
+    'Check if a microcode sequence can change the program counter or halt'
+    for code in seq:
+        ctb, btc = split_micro(code)
+        if ctb in ('HLT', 'CLR') or btc in ('PLI', 'PHI'):
+            return True
+    return False
+
+def block_exit(cycles, instructions, flags, pc):
+    'Return the lines leaving a block, flags and pc are None when only known at run time'
+    if flags is not None and pc is not None:
+        key = hex(flags << 16 | pc)
+    else:
+        key = '(' + ('eq << 1 | cy' if flags is None else str(flags)) + ') << 16 | ' + ('pc' if pc is None else hex(pc))
+    return ['cpu.cycles = cpu.cycles + ' + str(cycles),
+            'cpu.instructions = cpu.instructions + ' + str(instructions), '@EXIT ' + key]
+
+def translate_block(microcode, rom, start, flags, break_pts, watch=False):
+    '''Translate the instructions from start up to the next jump into a Block
+    Conditional jumps on flags set inside the block leave it only when taken
+    With watch, RAM accesses are checked against the watchpoints and the block is left after an instruction hitting one
+    The handler returns the (flags << 16 | pc) key of the next block'''
+    out_source, in_source = watch_source(MICRO_OUT, MICRO_IN) if watch else (MICRO_OUT, MICRO_IN)
+    body = []
+    cycles = 0
+    pc = start
+    end = start + 1
+    count = 0
+    closed = False
+    if rom[start] != 0xff:
+        body.append('cpu.no_op_count = 0')
+    while count < BLOCK_MAX:
+        code = hex(rom[pc])[2:].zfill(2)
+        if code not in microcode['base'] or (count > 0 and (rom[pc] == 0xff or pc in break_pts or pc < start)):
+            break
+        variants = [tuple(microcode[version][code]) for version in MICRO_VERSIONS]
+        count = count + 1
+        end = max(end, pc + 1)
+        body.append('# ' + hex(pc)[2:].zfill(4) + ' ' + code)
+        if flags is not None:
+            seq = variants[flags]
+        elif len(set(variants)) == 1:
+            seq = variants[0]
+        else:
+            # Flags were set inside the block, pick the microcode at run time
+            staying = set(seq for seq in variants if not ends_block(seq))
+            branches = sorted(set(variants) - staying if len(staying) == 1 else set(variants))
+            body.append('f = eq << 1 | cy')
+            for index, branch in enumerate(branches):
+                versions = [str(flag) for flag in range(len(variants)) if variants[flag] == branch]
+                if index == 0:
+                    body.append('if f in (' + ', '.join(versions) + ',):')
+                elif index < len(branches) - 1 or len(staying) == 1:
+                    body.append('elif f in (' + ', '.join(versions) + ',):')
+                else:
+                    body.append('else:')
+                seq_body, seq_cycles, seq_pc, seq_end = micro_source(branch, pc, rom, out_source, in_source)
+                if seq_pc is not None:
+                    seq_body.extend(pc_source(seq_pc))
+                seq_body.extend(block_exit(cycles + seq_cycles, count, None, seq_pc))
+                body.extend('    ' + line for line in seq_body)
+                end = max(end, seq_end)
+            if len(staying) != 1:
+                closed = True
+                break
+            # Fall through with the only variant not leaving the block
+            seq = staying.pop()
+        accesses_ram = watch and any(split_micro(code)[0] == 'RO' or split_micro(code)[1] == 'RI' for code in seq)
+        if accesses_ram:
+            # Named by watch_hit
+            body.append('cpu.instr_pc = ' + hex(pc))
+        seq_body, seq_cycles, pc, seq_end = micro_source(seq, pc, rom, out_source, in_source)
+        body.extend(seq_body)
+        cycles = cycles + seq_cycles
+        end = max(end, seq_end)
+        if any(split_micro(code)[1] == 'FI' for code in seq):
+            flags = None
+        if pc is None or ends_block(seq):
+            break
+        if accesses_ram:
+            # Watchpoints halt the CPU, leave before the next instruction as the stepped handlers do
+            body.append('if cpu.halted:')
+            body.extend('    ' + line for line in pc_source(pc) + block_exit(cycles, count, flags, pc))
+    if count == 0:
+        return None
+    if not closed:
+        if pc is not None:
+            body.extend(pc_source(pc))
+        body.extend(block_exit(cycles, count, flags, pc))
+    name = '<block ' + hex(start)[2:].zfill(4) + '>'
+    stop = start in break_pts or rom[start] == 0xff
+    return Block(make_handler(body, name), start, end, stop)
+
+def load_microcode(file_name, cache_file=MICROCODE_CACHE, debug=False):
+    '''Read the microcode and its compiled handlers from cache_file,
+    parsing file_name and rewriting the cache when the header changed'''
+    try:
+        with open(file_name, 'rb') as input_file:
+            header = input_file.read()
+    except IOError:
+        print('Cannot open file', file_name)
+        return False
+    key = '%s %d %s' % (sys.implementation.cache_tag, MICROCODE_PARSER_VERSION, hashlib.sha256(header).hexdigest())
+    cache_key = None
+    try:
+        with open(cache_file, 'rb') as input_file:
+            cache_key, microcode, code = marshal.loads(input_file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    if cache_key == key:
+        COMPILED_CODE.update(code)
+        if debug:
+            print('Read microcode from cache', cache_file)
+    else:
+        microcode = parse_microcode([line.strip() for line in header.decode().splitlines()], debug)
+    known_code = len(COMPILED_CODE)
+    compile_microcode(microcode)
+    if cache_key != key or len(COMPILED_CODE) > known_code:
+        # Replace the cache atomically, other simulators may be reading it
+        temp_file = cache_file + '.' + str(os.getpid())
+        try:
+            with open(temp_file, 'wb') as out_file:
+                out_file.write(marshal.dumps((key, microcode, COMPILED_CODE)))
+            os.replace(temp_file, cache_file)
+            if debug:
+                print('Wrote microcode cache', cache_file)
+        except OSError:
+            print('Cannot write microcode cache', cache_file)
+    return microcode
+
+def signal_names(defines):
+    'Return the chip to bus signal names by low nibble and the bus to chip ones by high nibble of the control byte'
+    out_names = {}
+    in_names = {}
+    for name, value in defines.items():
+        if value >> 4 == RomCpu.NO_CTRL and value & 0xf != RomCpu.NO_CTRL:
+            out_names[value & 0xf] = name
+        elif value & 0xf == RomCpu.NO_CTRL and value >> 4 != RomCpu.NO_CTRL:
+            in_names[value >> 4] = name
+    return out_names, in_names
+
+def control_names(defines):
+    'Return the micro-op of each control byte, written as in the microcode header'
+    out_names, in_names = signal_names(defines)
+    names = []
+    for ctrl in range(256):
+        out_name = out_names.get(ctrl & 0xf)
+        in_name = in_names.get(ctrl >> 4)
+        if out_name and in_name:
+            names.append(out_name + ' & ' + in_name)
+        else:
+            names.append(out_name or in_name or 'NOP')
+    return names
+
+def control_word(code, defines):
+    'Return the control byte of a micro-op'
+    ctb, btc = split_micro(code)
+    return defines.get(ctb, 0xff) & defines.get(btc, 0xff)
+
+def read_defines(file_name, debug=False):
+    'Read the control signal #defines from the microcode header'
+    try:
+        with open(file_name, 'r') as input_file:
+            lines = [line.strip() for line in input_file]
+    except IOError:
+        print('Cannot open file', file_name)
+        return False
+    defines = {}
+    for line in lines:
+        code = line.split('//')[0].split()
+        if len(code) == 3 and code[0] == '#define':
+            defines[code[1]] = int(code[2], 0)
+    if debug:
+        print('Read', len(defines), 'control signals')
+    return defines
+
+def read_control_rom(file_name, debug=False):
+    'Read the control ROM image written by microcodeGenerator'
+    try:
+        with open(file_name, 'r') as input_file:
+            lines = [line.strip() for line in input_file]
+            if debug:
+                print('Read', len(lines), 'lines from file', file_name)
+    except IOError:
+        print('Cannot open file', file_name)
+        return False
+    image = bytearray()
+    for line in lines:
+        if not line:
+            continue
+        address, data = line.split(':')
+        address = int(address, 16)
+        data = bytes.fromhex(data)
+        if len(image) < address + len(data):
+            image.extend(bytes(address + len(data) - len(image)))
+        image[address:address + len(data)] = data
+    if debug:
+        print('Read', len(image), 'bytes of control ROM')
+    return image
+
+# Assembler of the program loaded, see program_labels
+program_assembler = None
+
+def load_assembler(steps=False, debug=False, cache=True):
+    'Return a new assembler for the program to load'
+    global program_assembler
+    program_assembler = asm.Assembler(steps, debug, cache)
+    return program_assembler
+
+def load_program(infile, offset, steps=False, debug=False, cache=True):
+    'Return the program in infile, an assembler file or a code image (see asm.write_output), exiting on errors'
+    global program_assembler
+    if asm.image_format(infile):
+        program_assembler = None
+        program = asm.read_image(infile)
+        if not program:
+            print('Errors found, exiting')
+            sys.exit()
+        return program
+    return load_assembler(steps, debug, cache).translate_file(infile, offset)
+
+def program_labels():
+    'Return the addresses of the labels of the last program assembled'
+    return dict(program_assembler.label_mgr.labels) if program_assembler else {}
+
+def make_cpu(control_rom=False, clock_period=0, debug=False, mc_debug=False):
+    '''Return a CPU running the microcode header, or a control ROM image if control_rom:
+    the image built from the header (see microgen.py) if True, else the image file it names'''
+    if control_rom:
+        defines = read_defines(SRC_MICROCODE, debug)
+        if control_rom is True:
+            # Imports the simulator, so only loaded when needed
+            import microgen
+            control_rom = microgen.control_rom(SRC_MICROCODE, debug=debug)
+        else:
+            control_rom = read_control_rom(control_rom, debug)
+        return RomCpu(control_rom, defines, clock_period, debug, mc_debug)
+    microcode = load_microcode(SRC_MICROCODE, debug=debug)
+    return Cpu(microcode, clock_period, debug, mc_debug)
+
+# ----- batch runs -----
+# CPU reused for all the programs run by a batch worker process
+batch_cpu = None
+
+def init_batch_worker(control_rom=False):
+    'Load the microcode once per worker process'
+    global batch_cpu
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch_cpu = make_cpu(control_rom)
+
+def read_program(source, offset='0x0000'):
+    '''Return the {address: code} program of source, a file name or a (name, lines) pair
+    Files can hold assembler code or code written by the assembler'''
+    if isinstance(source, str) and asm.image_format(source):
+        return asm.read_image(source) or None
+    if isinstance(source, str):
+        lines = asm.read_file(source)
+        if not lines:
+            return None
+    else:
+        lines = source[1]
+    code = asm.parse_code(lines)
+    if code is None:
+        code = asm.Assembler().translate_cached(lines, int(offset, 16))
+    return code or None
+
+def run_program(cpu, source, offset='0x0000', max_cycles=None):
+    'Run a program from a clean CPU and return its outputs and final state'
+    name = source if isinstance(source, str) else source[0]
+    result = {'program': name}
+    start = time.perf_counter()
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            program = read_program(source, offset)
+            if program is not None:
+                cpu.clear_rom()
+                cpu.reset()
+                cpu.set_output_sink(out.RingSink())
+                cpu.load_rom(program)
+                cpu.exec_prog(max_cycles)
+    except Exception as error:
+        program = None
+        log = io.StringIO(repr(error))
+    if program is None:
+        # The assembler prints why it failed
+        result['error'] = log.getvalue().strip()
+    else:
+        result['halted'] = cpu.halted
+        result['outputs'] = cpu.output.get_values()
+        result['registers'] = {'a': cpu.reg_a, 'b': cpu.reg_b, 'c': cpu.reg_c, 'd': cpu.reg_d, 'o': cpu.reg_o,
+                               'pc': cpu.pc_ptr, 'ram_addr': cpu.ram_ptr,
+                               'carry': cpu.carry_flag, 'equal': cpu.equal_flag}
+        result['cycles'] = cpu.cycles
+        result['instructions'] = cpu.instructions
+    result['wall_time'] = time.perf_counter() - start
+    return result
+
+def run_batch_program(source, offset='0x0000', max_cycles=None):
+    return run_program(batch_cpu, source, offset, max_cycles)
+
+def run_batch(sources, jobs=None, offset='0x0000', max_cycles=None, control_rom=False):
+    '''Run each program of sources in a pool of jobs processes (all cores if None), on the control ROM image
+    if control_rom (see make_cpu). Sources are file names or (name, lines) pairs, results are yielded in the same order'''
+    # Only needed by batch runs, importing it takes longer than starting the simulator
+    from concurrent.futures import ProcessPoolExecutor
+    # Write the microcode or control ROM image cache once instead of in every worker
+    if not control_rom:
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_microcode(SRC_MICROCODE)
+    elif control_rom is True:
+        import microgen
+        with contextlib.redirect_stdout(io.StringIO()):
+            microgen.control_rom(SRC_MICROCODE)
+    run = functools.partial(run_batch_program, offset=offset, max_cycles=max_cycles)
+    with ProcessPoolExecutor(jobs, initializer=init_batch_worker, initargs=(control_rom,)) as executor:
+        yield from executor.map(run, sources)
+
+def read_batch_args(argv):
+    parser = argparse.ArgumentParser(prog='simulator.py batch', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Run programs to halt and print a JSON line per program')
+    parser.add_argument('infiles', nargs='+', type=str, help='Assembler or code files, glob patterns or folders')
+    parser.add_argument('-b', '--base', type=str, help='Specify starting address for assembler', default='0x0000', dest='offset')
+    parser.add_argument('-c', '--max-cycles', type=int, default=10000000, help='Micro instructions run before giving up on a program, 0 for no limit')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes, the number of cores if not given')
+    parser.add_argument('-r', '--control-rom', action='store_true', help='Execute the control ROM image built from the microcode header (see microgen.py) instead of the header')
+    parser.add_argument('--control-rom-file', type=str, default=None, help='Execute the control ROM image in this file (e.g. ../Microcode/data.txt written by microgen.py) instead of the microcode header')
+    return parser.parse_args(argv)
+
+def batch_main(argv):
+    args = read_batch_args(argv)
+    sources = asm.expand_sources(args.infiles)
+    for result in run_batch(sources, args.jobs, args.offset, args.max_cycles or None, args.control_rom_file or args.control_rom):
+        print(json.dumps(result), flush=True)
+
+if __name__ == '__main__' and sys.argv[1:2] == ['batch']:
+    batch_main(sys.argv[2:])
+elif __name__ == '__main__':
     print('Microprocessor simulator. Version 0.1')
 
     # Read command line arguments
@@ -584,8 +2056,22 @@ if __name__ == '__main__':
     #print(args)
 
     # Read microcode definitions
-    microcode = read_microcode(SRC_MICROCODE, args.debug)
-    cpu = Cpu(microcode, args.clock_period / 1000.0, args.debug, args.mcode_debug)
+    clock_period = 1.0 / args.frequency if args.frequency > 0 else args.clock_period / 1000.0
+    cpu = make_cpu(args.control_rom_file or args.control_rom, clock_period, args.debug, args.mcode_debug)
+    if args.output_file:
+        try:
+            cpu.set_output_sink(out.FileSink(args.output_file, args.binary_output))
+        except IOError:
+            print('Cannot open file', args.output_file)
+            sys.exit(1)
+    elif args.buffered_output:
+        cpu.set_output_sink(out.BufferedPrintSink())
+    if args.trace:
+        try:
+            cpu.set_tracer(args.trace)
+        except IOError:
+            print('Cannot open file', args.trace)
+            sys.exit(1)
 
     # Get the intput file name
     if args.infile:
@@ -594,17 +2080,25 @@ if __name__ == '__main__':
         infile = input('Name of input file? ')
 
     # Read program to execute
-    asm.label_mgr.set_debug(args.debug)
+    profile = args.profile or args.profile_json or args.profile_stacks
     if args.interactive:
         if args.infile:
-            program = asm.translate_file(infile, args.offset, args.steps, args.debug)
+            program = load_program(infile, args.offset, args.steps, args.debug, not args.no_cache)
             cpu.load_rom(program)
+        if profile:
+            cpu.set_profiler(True)
+        if cpu.profiler:
+            cpu.profiler.set_labels(program_labels())
         CmdLine().cmdloop()
     else:
-        program = asm.translate_file(infile, args.offset, args.steps, args.debug)
+        program = load_program(infile, args.offset, args.steps, args.debug, not args.no_cache)
         #print(asm.INST_SET)
         #print(program)
         cpu.load_rom(program)
+        if profile:
+            cpu.set_profiler(True)
+        if cpu.profiler:
+            cpu.profiler.set_labels(program_labels())
         print('Initial CPU state')
         cpu.print_cpu()
         try:
@@ -613,4 +2107,13 @@ if __name__ == '__main__':
             print('Interrupted...')
         print('Final CPU state')
         cpu.print_cpu()
+        cpu.output.close()
+        cpu.set_tracer(None)
+        if cpu.profiler:
+            if args.profile:
+                cpu.profiler.print_report()
+            if args.profile_json:
+                cpu.profiler.write_json(args.profile_json)
+            if args.profile_stacks:
+                cpu.profiler.write_stacks(args.profile_stacks, os.path.basename(infile))
 
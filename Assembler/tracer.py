@@ -0,0 +1,211 @@
+'''
+Execution trace
+Every micro instruction run is written as a fixed size binary record to a memory mapped file,
+the command line lists the records matching a query
+'''
+
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+import assembler as asm
+
+MAGIC = b'CPUTRACE'
+# Version 2 records hold the address of the instruction instead of the PC after the micro instruction
+VERSION = 2
+# Magic, version, record count, length of the control signal names (JSON) following the header
+HEADER = struct.Struct('<8sB7xQQ')
+# Records start after the header and the names
+DATA_START = 8192
+# Cycle, PC (address of the instruction), opcode, micro instruction step, control word, bus, A, B, C, D,
+# output register, flags (carry | equal << 1 | halted << 2) and RAM address after the micro instruction
+RECORD = struct.Struct('<QHBBBBBBBBBBH2x')
+FIELDS = ['cycle', 'pc', 'opcode', 'step', 'ctrl', 'bus', 'a', 'b', 'c', 'd', 'o', 'flags', 'ram_addr']
+# Records added to the file each time it fills up
+GROW_RECORDS = 1 << 20
+# Records unpacked at a time when reading
+READ_RECORDS = 1 << 16
+
+class TraceWriter():
+    'Writes trace records to a file growing as needed, names are the 256 control word names'
+
+    def __init__(self, file_name, names):
+        self.file_name = file_name
+        self.out_file = open(file_name, 'w+b')
+        names = json.dumps(names).encode()
+        if HEADER.size + len(names) > DATA_START:
+            raise ValueError('Control word names too long')
+        self.out_file.truncate(DATA_START + GROW_RECORDS * RECORD.size)
+        self.mm = mmap.mmap(self.out_file.fileno(), 0)
+        self.mm[HEADER.size:HEADER.size + len(names)] = names
+        self.names_size = len(names)
+        # Offset of the next record and size of the file
+        self.pos = DATA_START
+        self.end = len(self.mm)
+        self.pack = RECORD.pack_into
+
+    def reserve(self, count):
+        'Return the offset to write count records at, growing the file if needed'
+        pos = self.pos
+        self.pos = pos + count * RECORD.size
+        if self.pos > self.end:
+            self.grow()
+        return pos
+
+    def grow(self):
+        'Make the file big enough for the records up to pos and a few more'
+        self.end = self.pos + GROW_RECORDS * RECORD.size
+        self.mm.close()
+        self.out_file.truncate(self.end)
+        self.mm = mmap.mmap(self.out_file.fileno(), 0)
+
+    def write(self, *fields):
+        RECORD.pack_into(self.mm, self.reserve(1), *fields)
+
+    def count(self):
+        return (self.pos - DATA_START) // RECORD.size
+
+    def flush(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.count(), self.names_size)
+        self.mm.flush()
+
+    def close(self):
+        self.flush()
+        self.mm.close()
+        self.out_file.truncate(self.pos)
+        self.out_file.close()
+
+class TraceReader():
+    'Reads the records of a trace file without loading it in memory'
+
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as input_file:
+            self.mm = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, names_size = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a trace file')
+        self.names = json.loads(self.mm[HEADER.size:HEADER.size + names_size].decode())
+        # The count is only written when the trace is closed, use the records there are otherwise
+        self.count = count or (len(self.mm) - DATA_START) // RECORD.size
+
+    def records(self, start=0, end=None):
+        'Yield the records from index start to end as tuples of FIELDS values'
+        end = self.count if end is None else min(end, self.count)
+        while start < end:
+            chunk = min(end - start, READ_RECORDS)
+            offset = DATA_START + start * RECORD.size
+            yield from RECORD.iter_unpack(self.mm[offset:offset + chunk * RECORD.size])
+            start = start + chunk
+
+    def find_cycle(self, cycle):
+        'Return the index of the first record at or after cycle, records are in cycle order'
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if RECORD.unpack_from(self.mm, DATA_START + middle * RECORD.size)[0] < cycle:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, cycles=None, pcs=None, opcodes=None, regs=None, first_step=False):
+        '''Yield the records with cycle and instruction address in the (first, last) ranges cycles and pcs,
+        opcode in opcodes, the registers in regs (dict of field name and value) holding those values and, if first_step,
+        only the first micro instruction of each instruction'''
+        start = 0
+        end = None
+        if cycles:
+            start = self.find_cycle(cycles[0])
+            end = self.find_cycle(cycles[1] + 1)
+        checks = []
+        if pcs:
+            checks.append(lambda record: pcs[0] <= record[1] <= pcs[1])
+        if opcodes:
+            checks.append(lambda record: record[2] in opcodes)
+        if first_step:
+            checks.append(lambda record: record[3] == 0)
+        for field, value in (regs or {}).items():
+            index = FIELDS.index(field)
+            checks.append(lambda record, index=index, value=value: record[index] == value)
+        for record in self.records(start, end):
+            if all(check(record) for check in checks):
+                yield record
+
+    def close(self):
+        self.mm.close()
+
+def format_record(record, names):
+    'Return the lines showing a record in the layout of the simulator debug output'
+    cycle, pc, opcode, step, ctrl, bus, a, b, c, d, o, flags, ram_addr = record
+    h = lambda value, places=2: hex(value)[2:].zfill(places)
+    return ['--------------------------------',
+            ' '.join(['Cycle=', str(cycle), 'Microinstr ctr =', str(step), 'mcode =', names[ctrl]]),
+            ' '.join(['PC Addr=', str(pc), '(', h(pc >> 8), h(pc & 0xff), ') Instr=', h(opcode), '=', asm.get_instr_from_code(h(opcode))]),
+            ' '.join(['Reg A=', h(a), '(', str(a), ')  Reg B=', h(b), '(', str(b), ')']),
+            ' '.join(['Reg C=', h(c), '(', str(c), ')  Reg D=', h(d), '(', str(d), ')']),
+            ' '.join(['Output Reg=', h(o), '(', str(o), ')']),
+            ' '.join(['Bus data=', h(bus), '(', str(bus), ')']),
+            ' '.join(['Carry and Equal flags=', str(bool(flags & 1)), ',', str(bool(flags & 2)), ' Halted?', str(bool(flags & 4))]),
+            ' '.join(['RAM Addr=', str(ram_addr), '(', h(ram_addr >> 8), h(ram_addr & 0xff), ')'])]
+
+def read_range(text):
+    'Return the (first, last) range of a "first-last" or single hex value'
+    bounds = [int(value, 16) for value in text.split('-')]
+    return bounds[0], bounds[-1]
+
+def read_opcode(text):
+    'Return the code of an instruction given by name or hex code'
+    if text.upper() in asm.INST_SET:
+        return int(asm.INST_SET[text.upper()]['code'], 16)
+    return int(text, 16)
+
+def read_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='List the records of a trace file written by simulator.py -t')
+    parser.add_argument('infile', type=str, help='Trace file')
+    parser.add_argument('-c', '--cycles', type=str, default=None, help='Cycle range (decimal, first-last)')
+    parser.add_argument('-p', '--pc', type=str, default=None, help='Range of instruction addresses (hex, first-last)')
+    parser.add_argument('-o', '--opcode', type=str, action='append', default=[], help='Instruction name or hex code, can be repeated')
+    parser.add_argument('-r', '--reg', type=str, action='append', default=[],
+                        help='Field value (decimal) the records must have, e.g. a=5, can be repeated (' + ', '.join(FIELDS[5:]) + ')')
+    parser.add_argument('-f', '--first-step', action='store_true', help='Only list the first micro instruction of each instruction')
+    parser.add_argument('-n', '--limit', type=int, default=100, help='Records listed at most, 0 for all')
+    parser.add_argument('-s', '--summary', action='store_true', help='Only print how many records match')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = read_args()
+    try:
+        reader = TraceReader(args.infile)
+    except (IOError, ValueError) as error:
+        print('Cannot read trace file', args.infile, '(' + str(error) + ')')
+        sys.exit(1)
+    try:
+        cycles = [int(value) for value in args.cycles.split('-')] if args.cycles else None
+        if cycles:
+            cycles = cycles[0], cycles[-1]
+        regs = {}
+        for item in args.reg:
+            field, value = item.split('=')
+            if field not in FIELDS[5:]:
+                raise ValueError('Unknown field ' + field)
+            regs[field] = int(value)
+        records = reader.query(cycles, read_range(args.pc) if args.pc else None,
+                               set(read_opcode(opcode) for opcode in args.opcode), regs, args.first_step)
+    except ValueError as error:
+        print('Invalid query (' + str(error) + ')')
+        sys.exit(2)
+    print('Trace', args.infile, 'with', reader.count, 'records')
+    matched = 0
+    for record in records:
+        matched = matched + 1
+        if not args.summary:
+            print('\n'.join(format_record(record, reader.names)))
+            if matched == args.limit:
+                print('Listed the first', matched, 'matching records')
+                break
+    else:
+        print('Matched', matched, 'records')